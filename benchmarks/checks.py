@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+""" Deterministic checks for the rate limiter, the poll scheduler's budget and command
+    coalescing, run against a fake clock so they give the same result on any machine.
+    Run from the repository root: python benchmarks/checks.py
+    Exits non-zero if any check fails. """
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import polyMagicHome_limit
+import polyMagicHome_schedule
+from polyMagicHome_limit import RateLimiter, INTERACTIVE, BACKGROUND
+from polyMagicHome_schedule import PollScheduler
+from polyMagicHome_commands import Coalescer
+
+
+class FakeClock(object):
+    """ Stands in for the time module, only moves when advance() is called """
+
+    def __init__(self, now=1000000.):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeDevice(object):
+    """ Records the frames a Coalescer sends """
+
+    def __init__(self):
+        self.ipaddr = '127.0.0.1'
+        self.color = [0, 0, 0]
+        self.frames = []
+
+    def setRGB(self, r, g, b):
+        self.color = [r, g, b]
+        self.frames.append(('rgb', r, g, b))
+
+    def turnOn(self):
+        self.frames.append(('on',))
+
+    def turnOff(self):
+        self.frames.append(('off',))
+
+
+def wait_for(condition, timeout=5.):
+    """ Waits (in real time) for another thread to get somewhere """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out waiting for a worker thread')
+        time.sleep(0.001)
+
+
+def check_priority(clock):
+    """ Background requests give way while an interactive one waits: one waiting on the
+        same bulb gets its token after it, whichever wakes first """
+    limiter = RateLimiter(global_rate=0, bulb_rate=1, subnet_concurrency=0, jitter=0)
+    ip = '10.0.0.5'
+    assert limiter.try_acquire(ip)
+    limiter.release(ip) #the bulb's one token is spent
+    order = []
+    def request(priority):
+        if limiter.acquire(ip, priority=priority, timeout=None):
+            order.append(priority)
+    background = threading.Thread(target=request, args=(BACKGROUND,))
+    background.daemon = True
+    background.start()
+    wait_for(lambda: limiter._waiting[BACKGROUND] == 1)
+    interactive = threading.Thread(target=request, args=(INTERACTIVE,))
+    interactive.daemon = True
+    interactive.start()
+    wait_for(lambda: limiter._waiting[INTERACTIVE] == 1)
+    other = '10.0.0.6' #has a token, but background traffic gives way while a command waits
+    assert not limiter.try_acquire(other, priority=BACKGROUND), 'background request should give way'
+    assert limiter.try_acquire(other, priority=INTERACTIVE)
+    limiter.release(other)
+    clock.advance(1.) #one token
+    limiter.release('192.0.2.1') #wakes the waiters
+    interactive.join(5.)
+    assert order == [INTERACTIVE], 'interactive request should go first, got %s' % order
+    assert limiter._waiting[BACKGROUND] == 1, 'background request should still be waiting'
+    clock.advance(1.)
+    limiter.release('192.0.2.1')
+    background.join(5.)
+    assert order == [INTERACTIVE, BACKGROUND], 'background request should go second, got %s' % order
+    assert limiter.stats()['delayed'] == 2
+
+
+def check_subnet_cap(clock):
+    """ No more than subnet_concurrency requests in flight per subnet, other subnets unaffected """
+    limiter = RateLimiter(global_rate=0, bulb_rate=0, subnet_concurrency=2, jitter=0)
+    assert limiter.try_acquire('10.0.0.1')
+    assert limiter.try_acquire('10.0.0.2')
+    assert not limiter.try_acquire('10.0.0.3'), 'third request on the subnet should wait'
+    assert limiter.try_acquire('10.0.1.1'), 'another subnet has its own slots'
+    limiter.release('10.0.0.1')
+    assert limiter.try_acquire('10.0.0.3'), 'a released slot should be reused'
+    assert limiter.stats()['inflight'] == 3
+
+
+def check_rates(clock):
+    """ The fleet-wide bucket holds back requests to every bulb until it refills """
+    limiter = RateLimiter(global_rate=2, bulb_rate=0, subnet_concurrency=0, jitter=0)
+    granted = [limiter.try_acquire('10.0.%i.1' % i) for i in range(4)]
+    assert granted == [True, True, False, False], granted
+    clock.advance(0.5)
+    assert limiter.try_acquire('10.0.9.1'), 'a token should have refilled after 0.5s at 2/s'
+    assert not limiter.try_acquire('10.0.9.2')
+
+
+def check_budget(clock):
+    """ Due bulbs beyond the per-minute budget are deferred until tokens refill """
+    scheduler = PollScheduler(min_interval=5, max_interval=300, budget=6)
+    for i in range(10):
+        scheduler.add(i, delay=0)
+    due = scheduler.due()
+    assert due == range(6), 'budget should allow 6 queries, got %s' % due
+    assert scheduler.stats(reset=False)['deferred'] == 4
+    clock.advance(10.) #6/minute: one token
+    assert scheduler.due() == [6]
+    clock.advance(30.)
+    assert scheduler.due() == [7, 8, 9]
+    for i in range(10):
+        scheduler.polled(i, True, False)
+    assert scheduler.interval(0) == 10., 'unchanged bulb should back off'
+    assert scheduler.stats()['queries'] == 10
+
+
+def check_coalescing(clock):
+    """ Changes set within one window go out as one frame of the latest value """
+    device = FakeDevice()
+    sent = []
+    coalescer = Coalescer(device, window_ms=60000, on_sent=lambda: sent.append(1))
+    for level in range(20):
+        coalescer.set(color=[level, 255 - level, 300], frames=1)
+    coalescer.set(power=True)
+    assert coalescer.pending
+    assert coalescer.color == [19, 236, 255], coalescer.color
+    assert device.frames == [], 'nothing should go out before the window closes'
+    assert coalescer.flush()
+    assert device.frames == [('rgb', 19, 236, 255), ('on',)], device.frames
+    assert coalescer.saved == 19 and sent == [1]
+    assert not coalescer.pending
+    assert coalescer.flush() and len(device.frames) == 2, 'an empty flush sends nothing'
+
+
+CHECKS = [
+    ('limiter priority', check_priority),
+    ('subnet cap', check_subnet_cap),
+    ('rate buckets', check_rates),
+    ('poll budget', check_budget),
+    ('coalescing', check_coalescing),
+]
+
+def main():
+    failed = 0
+    for name, check in CHECKS:
+        clock = FakeClock()
+        polyMagicHome_limit.time = clock
+        polyMagicHome_schedule.time = clock
+        try:
+            check(clock)
+            print "{:<18} ok".format(name)
+        except AssertionError as e:
+            failed += 1
+            print "{:<18} FAILED: {}".format(name, e)
+        finally:
+            polyMagicHome_limit.time = time
+            polyMagicHome_schedule.time = time
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
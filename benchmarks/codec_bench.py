@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+""" Microbenchmark for flux_led_codec against the byte-at-a-time frame building it
+    replaced.  Run from the repository root: python benchmarks/codec_bench.py """
+
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import flux_led
+import flux_led_codec as codec
+
+STATE_REPLY = bytearray([0x81, 0x44, 0x23, 0x61, 0x21, 0x10, 0x0a, 0x14, 0x1e, 0x00, 0x04, 0x00, 0x00, 0x5c])
+PRESET_REPLY = bytearray([0x81, 0x44, 0x23, 0x38, 0x21, 0x10, 0x0a, 0x14, 0x1e, 0x00, 0x04, 0x00, 0x00, 0x33])
+
+def legacy_rgb(r, g, b, persist=True):
+    if persist:
+        msg = bytearray([0x31])
+    else:
+        msg = bytearray([0x41])
+    msg.append(r)
+    msg.append(g)
+    msg.append(b)
+    msg.append(0x00)
+    msg.append(0x00)
+    msg.append(0x0f)
+    msg.append(sum(msg) & 0xFF)
+    return msg
+
+def legacy_state(rx):
+    power_state = rx[2]
+    is_on = True if power_state == 0x23 else False if power_state == 0x24 else None
+    pattern = rx[3]
+    ww_level = rx[9]
+    mode = "unknown"
+    if pattern in [0x61, 0x62]:
+        mode = "ww" if ww_level != 0 else "color"
+    elif pattern == 0x60:
+        mode = "custom"
+    elif flux_led.PresetPattern.valid(pattern):
+        mode = "preset"
+    return is_on, pattern, mode, rx[5], rx[6], rx[7], rx[8], ww_level
+
+def legacy_valtostr(pattern):
+    for key, value in flux_led.PresetPattern.__dict__.iteritems():
+        if type(value) is int and value == pattern:
+            return key.replace("_", " ").title()
+    return None
+
+buf = bytearray(codec.RGB.size)
+
+CASES = [
+    ('rgb frame', lambda: legacy_rgb(10, 20, 30), lambda: codec.packRGB(buf, 0, 10, 20, 30)),
+    ('power frame', lambda: flux_led.utils.appendChecksum(bytearray([0x71, 0x23, 0x0f])), lambda: codec.POWER_ON),
+    ('state (color)', lambda: legacy_state(STATE_REPLY), lambda: codec.decodeState(STATE_REPLY)),
+    ('state (preset)', lambda: legacy_state(PRESET_REPLY), lambda: codec.decodeState(PRESET_REPLY)),
+    ('pattern name', lambda: legacy_valtostr(0x38), lambda: flux_led.PresetPattern.valtostr(0x38)),
+]
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--number", dest="number", type="int", default=100000,
+                      help="calls per measurement")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                      help="measurements per case, the best is reported")
+    (options, args) = parser.parse_args()
+
+    print "{:<15} {:>12} {:>12} {:>8}".format('case', 'legacy ns', 'codec ns', 'speedup')
+    for name, legacy, new in CASES:
+        old_ns = min(timeit.repeat(legacy, number=options.number, repeat=options.repeat)) / options.number * 1e9
+        new_ns = min(timeit.repeat(new, number=options.number, repeat=options.repeat)) / options.number * 1e9
+        print "{:<15} {:>12.0f} {:>12.0f} {:>7.1f}x".format(name, old_ns, new_ns, old_ns / new_ns)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark for polyMagicHome_color's batch color engine against the per-LED float
+    math it replaced, for a scene over many LEDs.  Run from the repository root:
+    python benchmarks/color_bench.py [-b 1000] """
+
+import os
+import random
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import polyMagicHome_color as color
+
+PURPLE = [160, 32, 240]
+
+def legacy_scale(color, level):
+    if max(color) == 0: color = [255,255,255] #no color to scale, use white
+    current_max = float(max(color))
+    return [int((c / current_max) * level) for c in color]
+
+def legacy_setcolor(color):
+    pct_brightness = max(color) / 255.
+    return [int(PURPLE[0] * pct_brightness), int(PURPLE[1] * pct_brightness), int(PURPLE[2] * pct_brightness)]
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-b", "--bulbs", dest="bulbs", type="int", default=1000,
+                      help="LEDs in the scene")
+    parser.add_option("-n", "--number", dest="number", type="int", default=200,
+                      help="scenes per measurement")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                      help="measurements per case, the best is reported")
+    (options, args) = parser.parse_args()
+
+    random.seed(0)
+    colors = [[random.randint(0, 255) for i in range(3)] for b in range(options.bulbs)]
+    levels = [random.randint(1, 255) for b in range(options.bulbs)]
+    engines = [('python', color.ColorEngine(use_numpy=False))]
+    if color.numpy is not None:
+        engines.append(('numpy', color.ColorEngine()))
+    else:
+        print "NumPy isn't installed, only the plain Python engine is measured"
+
+    cases = [
+        ('brightness', lambda: [legacy_scale(c, l) for c, l in zip(colors, levels)],
+         lambda e: e.scale(colors, levels)),
+        ('preset color', lambda: [legacy_setcolor(c) for c in colors],
+         lambda e: e.dim([PURPLE], e.levels(colors))),
+    ]
+    print "{} LEDs per scene".format(options.bulbs)
+    print "{:<13} {:>8} {:>12} {:>12} {:>8}".format('case', 'engine', 'per-LED us', 'engine us', 'speedup')
+    for name, legacy, batch in cases:
+        old_us = min(timeit.repeat(legacy, number=options.number, repeat=options.repeat)) / options.number * 1e6
+        for label, engine in engines:
+            new_us = min(timeit.repeat(lambda: batch(engine), number=options.number, repeat=options.repeat)) / options.number * 1e6
+            print "{:<13} {:>8} {:>12.0f} {:>12.0f} {:>7.1f}x".format(name, label, old_us, new_us, old_us / new_us)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+""" Fleet throughput benchmark against simulated controllers (benchmarks/simulator.py).
+    Measures discovery, single bulb and WifiLedFleet commands, a PollEngine cycle and
+    the BulbReactor state queries the node server's polls send, at several fleet sizes.
+    Run from the repository root:
+        python benchmarks/fleet_bench.py --sizes 1,10,100,500 --latency 0.005
+
+    Per operation it reports the median cycle time (all bulbs once), the p50/p99 latency
+    of the individual bulbs and the request frames sent per second.  The polls are
+    measured through the engines they run on, as the node server itself needs Polyglot:
+    "reactor query" is how the short poll queries the LEDs, "poll engine" the worker pool
+    used for new LEDs' first query and the timer sync. """
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import flux_led
+from polyMagicHome_poll import PollEngine
+from simulator import DISCOVERY_IP
+
+
+def percentile(values, pct):
+    if not values: return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100. * (len(values) - 1))))]
+
+def median(values):
+    return percentile(values, 50)
+
+
+class Stats(object):
+    """ Cycle times and per-bulb latencies of one operation over several rounds """
+    def __init__(self, name):
+        self.name = name
+        self.cycles = []
+        self.latencies = []
+        self.frames = 0
+        self.elapsed = 0.
+        self.failed = 0
+
+    def cycle(self, elapsed, latencies, frames, failed=0):
+        self.cycles.append(elapsed)
+        self.latencies.extend(latencies)
+        self.frames += frames
+        self.elapsed += elapsed
+        self.failed += failed
+
+    def row(self, size):
+        fps = self.frames / self.elapsed if self.elapsed else 0.
+        return "{:>6} {:<18} {:>10.1f} {:>9.2f} {:>9.2f} {:>10.0f} {:>7}".format(
+            size, self.name, median(self.cycles) * 1000, percentile(self.latencies, 50) * 1000,
+            percentile(self.latencies, 99) * 1000, fps, self.failed)
+
+
+def start_simulator(count, latency, jitter):
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'simulator.py'), '--count', str(count),
+                             '--latency', str(latency), '--jitter', str(jitter)], stdout=subprocess.PIPE)
+    controllers = []
+    for i in range(count):
+        line = proc.stdout.readline()
+        if not line:
+            raise RuntimeError('Simulator exited early')
+        ipaddr, port, macaddr = line.split()
+        controllers.append((ipaddr, int(port), macaddr))
+    return proc, controllers
+
+def stop_simulator(proc):
+    proc.terminate()
+    proc.wait()
+
+
+def bench_scan(controllers, rounds, timeout):
+    stats = Stats('scan')
+    scanner = flux_led.BulbScanner()
+    for i in range(rounds):
+        start = time.time()
+        found = 0
+        latencies = []
+        for item in scanner.scanIter(timeout, expected=len(controllers), address=DISCOVERY_IP):
+            found += 1
+            latencies.append(time.time() - start)
+        stats.cycle(time.time() - start, latencies, 1, len(controllers) - found)
+    return stats
+
+def bench_probe(controllers, rounds, timeout):
+    stats = Stats('probe')
+    scanner = flux_led.BulbScanner()
+    addresses = [c[0] for c in controllers]
+    for i in range(rounds):
+        start = time.time()
+        latencies = []
+        for item in scanner.probeIter(addresses, timeout):
+            latencies.append(time.time() - start)
+        stats.cycle(time.time() - start, latencies, len(addresses), len(addresses) - len(latencies))
+    return stats
+
+def bench_serial(name, bulbs, rounds, call):
+    """ One bulb at a time, the way the node server talked to its bulbs before the fleet """
+    stats = Stats(name)
+    for i in range(rounds):
+        latencies = []
+        failed = 0
+        start = time.time()
+        for bulb in bulbs:
+            t = time.time()
+            try:
+                ok = call(bulb) is not False
+            except (flux_led.BulbError, socket.error):
+                ok = False
+            if not ok:
+                failed += 1
+            else:
+                latencies.append(time.time() - t)
+        stats.cycle(time.time() - start, latencies, len(bulbs), failed)
+    return stats
+
+def bench_fleet(name, fleet, rounds, call):
+    stats = Stats(name)
+    for i in range(rounds):
+        start = time.time()
+        results = call(fleet)
+        elapsed = time.time() - start
+        failed = len([ok for ok in results.values() if not ok])
+        stats.cycle(elapsed, fleet.latencies.values(), len(results), failed)
+    return stats
+
+def bench_poll_engine(bulbs, rounds, engine, timeout):
+    stats = Stats('poll engine')
+    def task(bulb):
+        t = time.time()
+        ok = bulb.refreshState()
+        latencies.append(time.time() - t) #list.append is atomic, safe from the workers
+        return ok
+    for i in range(rounds):
+        latencies = []
+        result = engine.run(bulbs, task, timeout)
+        stats.cycle(result.duration, latencies, len(bulbs), len(result.failed) + len(result.stale))
+    return stats
+
+def bench_reactor(bulbs, rounds, reactor, timeout):
+    """ Every bulb queried at once through the reactor, the way the short poll does it """
+    stats = Stats('reactor query')
+    for i in range(rounds):
+        latencies = []
+        replies = [0]
+        done = threading.Event()
+        def callback(bulb, ok):
+            # called on the reactor thread
+            if ok: latencies.append(time.time() - start)
+            replies[0] += 1
+            if replies[0] == len(bulbs): done.set()
+        start = time.time()
+        for bulb in bulbs:
+            reactor.query(bulb, callback)
+        done.wait(timeout * 5)
+        stats.cycle(time.time() - start, latencies, len(bulbs), len(bulbs) - len(latencies))
+    return stats
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes", default="1,10,100,500",
+                      help="comma separated fleet sizes")
+    parser.add_option("-r", "--rounds", dest="rounds", type="int", default=5,
+                      help="cycles per operation")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.005,
+                      help="simulated reply latency in seconds")
+    parser.add_option("-j", "--jitter", dest="jitter", type="float", default=0.,
+                      help="random +/- variation of the reply latency in seconds")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=16,
+                      help="poll engine workers (the poll_workers setting)")
+    parser.add_option("-t", "--timeout", dest="timeout", type="float", default=5.,
+                      help="bulb/cycle timeout in seconds")
+    (options, args) = parser.parse_args()
+
+    engine = PollEngine(options.workers, options.timeout, options.timeout * 5)
+    print "{:>6} {:<18} {:>10} {:>9} {:>9} {:>10} {:>7}".format(
+        'bulbs', 'operation', 'cycle ms', 'p50 ms', 'p99 ms', 'frames/s', 'failed')
+    for size in [int(s) for s in options.sizes.split(',')]:
+        proc, controllers = start_simulator(size, options.latency, options.jitter)
+        try:
+            bulbs = [flux_led.WifiLedBulb(ip, mac, port=port, timeout=options.timeout) for ip, port, mac in controllers]
+            fleet = flux_led.WifiLedFleet(bulbs, options.timeout)
+            colors = dict((b, (i % 256, 128, 255 - i % 256)) for i, b in enumerate(bulbs))
+            results = [
+                bench_scan(controllers, options.rounds, options.timeout),
+                bench_probe(controllers, options.rounds, options.timeout),
+                bench_serial('refreshState', bulbs, options.rounds, lambda b: b.refreshState()),
+                bench_serial('setRGB', bulbs, options.rounds, lambda b: b.setRGB(10, 20, 30)),
+                bench_fleet('fleet refreshState', fleet, options.rounds, lambda f: f.refreshState()),
+                bench_fleet('fleet setColors', fleet, options.rounds, lambda f: f.setColors(colors)),
+                bench_poll_engine(bulbs, options.rounds, engine, options.timeout),
+            ]
+            reactor = flux_led.BulbReactor(options.timeout).start()
+            results.append(bench_reactor(bulbs, options.rounds, reactor, options.timeout))
+            reactor.stop()
+            for stats in results:
+                print stats.row(size)
+            sys.stdout.flush()
+            for bulb in bulbs:
+                bulb.disconnect()
+        finally:
+            stop_simulator(proc)
+
+if __name__ == '__main__':
+    main()
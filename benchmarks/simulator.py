@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+""" Simulated MagicHome controllers for benchmarking and soak testing without hardware.
+
+    Each VirtualController speaks the TCP protocol (state, power, color, preset, custom
+    pattern, clock and timer frames) and answers the HF-A11ASSISTHREAD discovery request.
+    One Simulator runs any number of them from a single poll() loop, either one per
+    loopback address (127.0.1.1:5577, 127.0.1.2:5577, ... every 127/8 address is local on
+    Linux) or all on 127.0.0.1 with one port each.  Loopback can't carry a real broadcast,
+    so a shared responder on its own address (127.255.255.254 by default) answers discovery
+    for every controller, point BulbScanner.scan's address at it.
+
+    Run standalone to serve controllers for a benchmark in another process:
+        python benchmarks/simulator.py --count 100 --latency 0.02
+"""
+
+import datetime
+import errno
+import heapq
+import random
+import select
+import socket
+import struct
+import sys
+import time
+import threading
+from optparse import OptionParser
+
+DISCOVERY_PORT = 48899
+DISCOVERY_MSG = "HF-A11ASSISTHREAD"
+DISCOVERY_IP = '127.255.255.254'
+
+def _checksum(frame):
+    frame.append(sum(frame) & 0xFF)
+    return frame
+
+# Length of each request frame by its first byte (checksum included)
+FRAME_LENGTHS = {0x81: 4, 0x71: 4, 0x31: 8, 0x41: 8, 0x61: 5, 0x51: 70,
+                 0x11: 5, 0x10: 12, 0x22: 5, 0x21: 88}
+
+
+class VirtualController(object):
+    """ State and protocol handling for one simulated controller """
+
+    def __init__(self, ipaddr, port, macaddr, model='AK001-ZJ100', latency=0., jitter=0.):
+        self.ipaddr = ipaddr
+        self.port = port
+        self.macaddr = macaddr
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.on = True
+        self.pattern = 0x61
+        self.delay = 0x10
+        self.color = [255, 255, 255]
+        self.ww = 0
+        self.custom = None
+        self.timers = bytearray([0x0f] + [0] * 13) * 6
+        self.clock_offset = 0.
+        self.frames = 0 #frames received
+        self.replies = 0 #replies sent
+
+    def reply_delay(self):
+        return max(0., self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def discovery_reply(self):
+        return '{},{},{}'.format(self.ipaddr, self.macaddr, self.model)
+
+    def handle(self, frame):
+        """ Applies one complete request frame, returns the reply (or None) """
+        self.frames += 1
+        opcode = frame[0]
+        if opcode == 0x81:
+            reply = bytearray([0x81, 0x44, 0x23 if self.on else 0x24, self.pattern, 0x21, self.delay,
+                               self.color[0], self.color[1], self.color[2], self.ww, 0x04, 0x00, 0x00])
+            return _checksum(reply)
+        elif opcode == 0x71:
+            self.on = frame[1] == 0x23
+        elif opcode in (0x31, 0x41):
+            self.color = [frame[1], frame[2], frame[3]]
+            self.ww = frame[4]
+            self.pattern = 0x61 if opcode == 0x31 else 0x62
+        elif opcode == 0x61:
+            self.pattern = frame[1]
+            self.delay = frame[2]
+        elif opcode == 0x51:
+            self.custom = bytearray(frame[:64])
+            self.pattern = 0x60
+            self.delay = frame[65]
+        elif opcode == 0x11:
+            now = datetime.datetime.now() + datetime.timedelta(seconds=self.clock_offset)
+            reply = bytearray([0x0f, 0x11, 0x14, now.year - 2000, now.month, now.day, now.hour,
+                               now.minute, now.second, now.isoweekday(), 0x00])
+            return _checksum(reply)
+        elif opcode == 0x10:
+            try:
+                then = datetime.datetime(2000 + frame[2], frame[3], frame[4], frame[5], frame[6], frame[7])
+                self.clock_offset = (then - datetime.datetime.now()).total_seconds()
+            except ValueError: pass
+        elif opcode == 0x22:
+            return _checksum(bytearray([0x0f, 0x22]) + self.timers + bytearray([0x00]))
+        elif opcode == 0x21:
+            self.timers = bytearray(frame[1:85])
+            return _checksum(bytearray([0x0f, 0x21, 0x00]))
+        return None
+
+
+class Simulator(object):
+    """ Serves VirtualControllers from one background thread """
+
+    def __init__(self, count, latency=0., jitter=0., base_ip='127.0.1.1', port=5577, use_ports=False,
+                 discovery_ip=DISCOVERY_IP):
+        self.discovery_ip = discovery_ip
+        self.controllers = []
+        base = struct.unpack('>I', socket.inet_aton(base_ip))[0]
+        for i in range(count):
+            if use_ports:
+                ipaddr, cport = base_ip, port + i
+            else:
+                ipaddr, cport = socket.inet_ntoa(struct.pack('>I', base + i)), port
+            macaddr = 'ACCF23{:06X}'.format(i)
+            self.controllers.append(VirtualController(ipaddr, cport, macaddr, latency=latency, jitter=jitter))
+        self._listeners = {} #fd: (socket, controller)
+        self._udp = {} #fd: (socket, controller)
+        self._conns = {} #fd: [socket, controller, receive buffer]
+        self._pending = [] #heap of (due, seq, fd, socket, reply)
+        self._seq = 0
+        self._poller = select.poll()
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        for c in self.controllers:
+            self._listen(c)
+        if self.discovery_ip:
+            us = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            us.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            us.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            us.bind((self.discovery_ip, DISCOVERY_PORT))
+            us.setblocking(0)
+            self._udp[us.fileno()] = (us, None)
+            self._poller.register(us, select.POLLIN)
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name='magichome-sim')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(2)
+        for table in (self._listeners, self._udp, self._conns):
+            for entry in table.values():
+                try:
+                    entry[0].close()
+                except socket.error: pass
+            table.clear()
+
+    def disconnect(self, controller):
+        """ Drops every open connection to controller """
+        with self._lock:
+            for fd, (sock, c, rx) in self._conns.items():
+                if c is controller:
+                    self._close(fd)
+
+    def move(self, controller, ipaddr):
+        """ Moves controller to a new address, as a DHCP lease change would.  Open
+            connections are dropped and the old address stops answering. """
+        with self._lock:
+            for table in (self._listeners, self._udp):
+                for fd, (sock, c) in table.items():
+                    if c is controller:
+                        self._poller.unregister(fd)
+                        sock.close()
+                        del table[fd]
+            for fd, (sock, c, rx) in self._conns.items():
+                if c is controller:
+                    self._close(fd)
+            controller.ipaddr = ipaddr
+            self._listen(controller)
+
+    def _listen(self, c):
+        ls = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        ls.bind((c.ipaddr, c.port))
+        ls.listen(16)
+        ls.setblocking(0)
+        self._listeners[ls.fileno()] = (ls, c)
+        self._poller.register(ls, select.POLLIN)
+        us = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        us.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            us.bind((c.ipaddr, DISCOVERY_PORT))
+        except socket.error:
+            # only one controller per address can answer discovery
+            us.close()
+        else:
+            us.setblocking(0)
+            self._udp[us.fileno()] = (us, c)
+            self._poller.register(us, select.POLLIN)
+
+    def _close(self, fd):
+        entry = self._conns.pop(fd, None)
+        if entry is None: return
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, ValueError): pass
+        try:
+            entry[0].close()
+        except socket.error: pass
+
+    def _loop(self):
+        while self._running:
+            timeout = 100
+            if self._pending:
+                timeout = max(0, min(timeout, int((self._pending[0][0] - time.time()) * 1000) + 1))
+            try:
+                events = self._poller.poll(timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            with self._lock:
+                for fd, event in events:
+                    if fd in self._listeners:
+                        self._accept(fd)
+                    elif fd in self._udp:
+                        self._discovery(fd)
+                    elif fd in self._conns:
+                        self._receive(fd)
+                now = time.time()
+                while self._pending and self._pending[0][0] <= now:
+                    due, seq, fd, sock, reply = heapq.heappop(self._pending)
+                    self._send(fd, sock, reply)
+
+    def _accept(self, fd):
+        ls, c = self._listeners[fd]
+        try:
+            conn, addr = ls.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        self._conns[conn.fileno()] = [conn, c, bytearray()]
+        self._poller.register(conn, select.POLLIN)
+        self.on_accept(conn.fileno(), c)
+
+    def on_accept(self, fd, controller):
+        """ Called for each new connection, override to inject faults """
+        pass
+
+    def _discovery(self, fd):
+        us, c = self._udp[fd]
+        try:
+            data, addr = us.recvfrom(64)
+        except socket.error:
+            return
+        if data != DISCOVERY_MSG:
+            return
+        for controller in (self.controllers if c is None else [c]):
+            try:
+                us.sendto(controller.discovery_reply(), addr)
+            except socket.error: pass
+
+    def _receive(self, fd):
+        conn, c, rx = self._conns[fd]
+        try:
+            data = conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            data = ''
+        if not data:
+            self._close(fd)
+            return
+        rx.extend(data)
+        while rx:
+            length = FRAME_LENGTHS.get(rx[0])
+            if length is None:
+                del rx[0] #not the start of a frame, resync
+                continue
+            if len(rx) < length:
+                break
+            frame = rx[:length]
+            del rx[:length]
+            self.on_frame(fd, c, frame)
+
+    def on_frame(self, fd, controller, frame):
+        """ Handles one frame from connection fd, override to inject faults """
+        reply = controller.handle(frame)
+        if reply is not None:
+            self.reply(fd, reply, controller.reply_delay())
+
+    def reply(self, fd, data, delay=0.):
+        """ Sends data on connection fd after delay seconds, unless it closes first """
+        entry = self._conns.get(fd)
+        if entry is None: return
+        self._seq += 1
+        heapq.heappush(self._pending, (time.time() + delay, self._seq, fd, entry[0], data))
+
+    def _send(self, fd, sock, data):
+        entry = self._conns.get(fd)
+        if entry is None or entry[0] is not sock: return #closed, fd may have been reused
+        try:
+            entry[0].sendall(data)
+            entry[1].replies += 1
+        except socket.error:
+            self._close(fd)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--count", dest="count", type="int", default=10,
+                      help="number of controllers")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.,
+                      help="reply latency in seconds")
+    parser.add_option("-j", "--jitter", dest="jitter", type="float", default=0.,
+                      help="random +/- variation of the reply latency in seconds")
+    parser.add_option("-b", "--base", dest="base_ip", default='127.0.1.1',
+                      help="address of the first controller")
+    parser.add_option("-p", "--port", dest="port", type="int", default=5577,
+                      help="TCP port (first port with --use-ports)")
+    parser.add_option("-d", "--discovery", dest="discovery_ip", default=DISCOVERY_IP,
+                      help="address of the shared discovery responder, empty for none")
+    parser.add_option("--use-ports", dest="use_ports", action="store_true", default=False,
+                      help="put every controller on the base address with its own port")
+    (options, args) = parser.parse_args()
+
+    sim = Simulator(options.count, options.latency, options.jitter, options.base_ip, options.port, options.use_ports,
+                    options.discovery_ip).start()
+    for c in sim.controllers:
+        print "{} {} {}".format(c.ipaddr, c.port, c.macaddr)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+""" Fault injection soak test for the bulb connection, command and poll paths.
+    Runs simulated controllers (benchmarks/simulator.py) that misbehave the way real
+    ones do, drives them the way the node server does (long poll through a PollEngine,
+    commands through each LED's CommandQueue and Coalescer) and reports how long bulbs
+    take to recover, how many commands never reach the controller and whether any
+    thread gets stuck.  Run from the repository root:
+        python benchmarks/soak.py --count 20 --duration 3600
+
+    Faults (--faults, comma separated):
+        rst       reset the connection, halfway through the reply if there is one
+        partial   send the reply in several pieces
+        stall     hold the reply past the bulb timeout
+        stray     send bytes that aren't part of any reply
+        takeover  a second client (the phone app) connects, the controller drops the first
+        ipchange  the controller moves to another address
+    rst, partial, stall and stray hit --rate of all frames, takeover and ipchange happen
+    every --takeover / --ipchange seconds on average.  Outages are timed from the first
+    failed poll to the first good one, so recovery times are in steps of --poll. """
+
+import logging
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import flux_led
+import flux_led_codec as codec
+from polyMagicHome_commands import Coalescer, CommandQueue
+from polyMagicHome_poll import PollEngine
+from simulator import Simulator
+from fleet_bench import percentile
+
+FRAME_FAULTS = ('rst', 'partial', 'stall', 'stray')
+FAULTS = FRAME_FAULTS + ('takeover', 'ipchange')
+
+
+class FaultySimulator(Simulator):
+    """ Simulator whose controllers misbehave.  Like the real thing, each controller
+        serves one client at a time, a new connection drops the one before it. """
+
+    def __init__(self, count, faults=FRAME_FAULTS, rate=0.01, stall=10., **kwargs):
+        super(FaultySimulator, self).__init__(count, **kwargs)
+        self.faults = [f for f in faults if f in FRAME_FAULTS]
+        self.rate = rate
+        self.stall = stall
+        self.injected = dict((f, 0) for f in FAULTS)
+
+    def on_accept(self, fd, controller):
+        for other, (sock, c, rx) in self._conns.items():
+            if c is controller and other != fd:
+                self.injected['takeover'] += 1
+                self._close(other)
+
+    def on_frame(self, fd, controller, frame):
+        if not self.faults or random.random() >= self.rate:
+            return super(FaultySimulator, self).on_frame(fd, controller, frame)
+        fault = random.choice(self.faults)
+        self.injected[fault] += 1
+        if fault == 'rst':
+            # a write is lost, a reply is cut off
+            if frame[0] in (0x81, 0x11, 0x22, 0x21):
+                reply = controller.handle(frame)
+                try:
+                    self._conns[fd][0].send(reply[:len(reply) // 2])
+                except socket.error: pass
+            self._reset(fd)
+            return
+        reply = controller.handle(frame)
+        delay = controller.reply_delay()
+        if fault == 'stray':
+            self.reply(fd, bytearray(random.randint(0, 0x7f) for i in range(random.randint(1, 4))), delay)
+            if reply is not None:
+                self.reply(fd, reply, delay)
+        elif reply is None:
+            return
+        elif fault == 'partial':
+            cuts = sorted(random.sample(range(1, len(reply)), min(len(reply) - 1, random.randint(1, 3))))
+            for i, (start, end) in enumerate(zip([0] + cuts, cuts + [len(reply)])):
+                self.reply(fd, reply[start:end], delay + i * 0.02)
+        elif fault == 'stall':
+            self.reply(fd, reply, self.stall)
+
+    def _reset(self, fd):
+        entry = self._conns.get(fd)
+        if entry is None: return
+        try:
+            # linger 0 makes close() send a RST instead of a FIN
+            entry[0].setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except socket.error: pass
+        self._close(fd)
+
+
+class Soak(object):
+
+    def __init__(self, options):
+        self.options = options
+        faults = [f.strip() for f in options.faults.split(',') if f.strip()]
+        self.faults = faults
+        self.sim = FaultySimulator(options.count, faults, options.rate, options.timeout * 2,
+                                   latency=options.latency, jitter=options.latency / 2.)
+        self.log = logging.getLogger('soak')
+        self.engine = PollEngine(options.workers, options.timeout, options.poll * 5, self.log)
+        self.bulbs = []
+        self.controller = {} #bulb: VirtualController
+        self.queues = {}
+        self.coalescers = {}
+        self.down_since = {} #bulb: time of the first failed poll of the current outage
+        self.outages = 0
+        self.recoveries = []
+        self.polls = self.polls_ok = 0
+        self.expected = {} #bulb: (color, time set) not checked yet
+        self.commands = self.delivered = self.dropped = self.superseded = 0
+        self.progress = {} #queue: (processed, time it last changed)
+        self.busy_since = {}
+        self.stuck_queues = self.stuck_polls = 0
+        self.threads = 0
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.sim.start()
+        for c in self.sim.controllers:
+            bulb = flux_led.WifiLedBulb(c.ipaddr, c.macaddr, c.model, port=c.port,
+                                        timeout=self.options.timeout, autoconnect=False)
+            self.bulbs.append(bulb)
+            self.controller[bulb] = c
+            self.queues[bulb] = CommandQueue(c.macaddr.lower(), self.log)
+            self.coalescers[bulb] = Coalescer(bulb, self.options.window, None, self.log, self.queues[bulb])
+        self._running = True
+        self._spawn(self._commander, 'soak-commands')
+        if 'takeover' in self.faults:
+            self._spawn(self._phone_app, 'soak-takeover')
+        if 'ipchange' in self.faults:
+            self._spawn(self._dhcp, 'soak-ipchange')
+        self.threads = threading.active_count()
+
+    def stop(self):
+        self._running = False
+        self.sim.stop()
+
+    def _spawn(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+
+    def _every(self, interval):
+        """ Sleeps for a random (exponentially distributed) time averaging interval,
+            returns False once the soak is over """
+        time.sleep(random.expovariate(1. / interval))
+        return self._running
+
+    def _commander(self):
+        while self._every(self.options.command):
+            bulb = random.choice(self.bulbs)
+            color = [random.randint(0, 255) for i in range(3)]
+            with self._lock:
+                if bulb in self.expected:
+                    self.superseded += 1 #coalesced into this one, latest wins
+                self.expected[bulb] = (color, time.time())
+                self.commands += 1
+            self.coalescers[bulb].set(color=color)
+
+    def _phone_app(self):
+        while self._every(self.options.takeover):
+            c = random.choice(self.sim.controllers)
+            try:
+                sock = socket.create_connection((c.ipaddr, c.port), 2)
+                sock.sendall(codec.STATE_QUERY)
+                sock.recv(14)
+                time.sleep(random.uniform(0.5, 3))
+                sock.close()
+            except socket.error: pass
+
+    def _dhcp(self):
+        next_ip = struct.unpack('>I', socket.inet_aton('127.0.100.1'))[0]
+        while self._every(self.options.ipchange):
+            c = random.choice(self.sim.controllers)
+            self.sim.move(c, socket.inet_ntoa(struct.pack('>I', next_ip)))
+            self.sim.injected['ipchange'] += 1
+            next_ip += 1
+
+    def poll(self):
+        result = self.engine.run(self.bulbs, lambda b: b.refreshState())
+        now = time.time()
+        self.polls += len(self.bulbs)
+        self.polls_ok += len(result.ok)
+        for bulb in self.bulbs:
+            if bulb in result.ok:
+                since = self.down_since.pop(bulb, None)
+                if since is not None:
+                    self.recoveries.append(now - since)
+            elif bulb not in self.down_since:
+                self.down_since[bulb] = now
+                self.outages += 1
+        self.check_commands(now)
+        self.check_stuck(now)
+
+    def check_commands(self, now):
+        """ A command is dropped if, once it has had time to go out, the controller
+            doesn't have its color and nothing newer is on the way """
+        settle = self.options.window / 1000. + 2 * self.options.timeout
+        with self._lock:
+            for bulb, (color, when) in self.expected.items():
+                if now - when < settle: continue
+                if self.queues[bulb].depth > 0 or self.coalescers[bulb].pending:
+                    continue #still on its way
+                del self.expected[bulb]
+                if self.controller[bulb].color == color:
+                    self.delivered += 1
+                else:
+                    self.dropped += 1
+
+    def check_stuck(self, now):
+        limit = self.options.stuck
+        self.stuck_queues = 0
+        for bulb, queue in self.queues.items():
+            processed, since = self.progress.get(queue, (None, now))
+            if queue.processed != processed or queue.depth == 0:
+                self.progress[queue] = (queue.processed, now)
+            elif now - since > limit:
+                self.stuck_queues += 1
+        busy = self.engine.busy
+        for bulb in self.busy_since.keys():
+            if bulb not in busy: del self.busy_since[bulb]
+        for bulb in busy:
+            self.busy_since.setdefault(bulb, now)
+        self.stuck_polls = len([b for b, since in self.busy_since.items() if now - since > limit])
+
+    def report(self, elapsed):
+        down = [time.time() - since for since in self.down_since.values()]
+        ok = 100. * self.polls_ok / self.polls if self.polls else 0.
+        return ('{:.0f}s: polls {} ({:.1f}% ok), outages {}, recovered {} (p50 {:.2f}s p99 {:.2f}s max {:.2f}s), '
+                'down now {} (longest {:.0f}s), commands {} delivered {} superseded {} dropped {}, stuck queues {} polls {}, '
+                'threads {} ({:+d}), faults {}').format(
+            elapsed, self.polls, ok, self.outages, len(self.recoveries), percentile(self.recoveries, 50),
+            percentile(self.recoveries, 99), max(self.recoveries or [float('nan')]), len(down), max(down or [0]),
+            self.commands, self.delivered, self.superseded, self.dropped, self.stuck_queues, self.stuck_polls,
+            threading.active_count(), threading.active_count() - self.threads,
+            ' '.join('{}={}'.format(f, self.sim.injected[f]) for f in FAULTS if f in self.faults))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--count", dest="count", type="int", default=10,
+                      help="number of controllers")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=3600.,
+                      help="seconds to run for")
+    parser.add_option("-f", "--faults", dest="faults", default=','.join(FAULTS),
+                      help="faults to inject: " + ', '.join(FAULTS))
+    parser.add_option("--rate", dest="rate", type="float", default=0.01,
+                      help="share of frames hit by rst, partial, stall or stray")
+    parser.add_option("--takeover", dest="takeover", type="float", default=60.,
+                      help="mean seconds between phone app connections")
+    parser.add_option("--ipchange", dest="ipchange", type="float", default=600.,
+                      help="mean seconds between address changes")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.01,
+                      help="simulated reply latency in seconds")
+    parser.add_option("-t", "--timeout", dest="timeout", type="float", default=2.,
+                      help="bulb timeout in seconds (bulb_timeout)")
+    parser.add_option("-p", "--poll", dest="poll", type="float", default=5.,
+                      help="seconds between poll cycles")
+    parser.add_option("--command", dest="command", type="float", default=0.5,
+                      help="mean seconds between commands")
+    parser.add_option("-w", "--window", dest="window", type="int", default=50,
+                      help="command coalescing window in ms (command_window_ms)")
+    parser.add_option("--workers", dest="workers", type="int", default=16,
+                      help="poll engine workers (poll_workers)")
+    parser.add_option("--stuck", dest="stuck", type="float", default=30.,
+                      help="seconds without progress before a thread counts as stuck")
+    parser.add_option("-r", "--report", dest="report", type="float", default=60.,
+                      help="seconds between progress reports")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="log every command and poll error")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('soak').setLevel(logging.ERROR if options.verbose else logging.CRITICAL)
+
+    soak = Soak(options)
+    soak.start()
+    start = time.time()
+    next_report = start + options.report
+    try:
+        while time.time() - start < options.duration:
+            cycle = time.time()
+            soak.poll()
+            if time.time() >= next_report:
+                print soak.report(time.time() - start)
+                sys.stdout.flush()
+                next_report += options.report
+            time.sleep(max(0., options.poll - (time.time() - cycle)))
+    except KeyboardInterrupt:
+        pass
+    print soak.report(time.time() - start)
+    soak.stop()
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,80 @@ Modified from https://github.com/beville/flux_led to work as a component of the
 * Reading timers
 * Setting timers
 """
+import os
 import socket
+import select
+import struct
+import threading
+import errno
 import time
+import random
 import sys
 import datetime
 from optparse import OptionParser,OptionGroup
 import ast
+import traceback
+import flux_led_codec as codec
+
+class BulbError(Exception):
+    """ Base class for errors talking to a controller """
+    pass
+
+class ReadTimeout(BulbError):
+    """ The controller didn't send the whole reply before the deadline """
+    pass
+
+class ShortRead(BulbError):
+    """ The connection closed part way through a reply """
+    pass
+
+class NotConnected(BulbError):
+    """ There is no connection and the reconnect backoff hasn't expired yet """
+    pass
+
+class Throttled(BulbError):
+    """ The rate limiter had no slot for the request in time, nothing was sent """
+    pass
+
+class _Unlimited(object):
+    """ Stands in for a rate limiter slot when there is no limiter """
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+UNLIMITED = _Unlimited()
+
+def timed(op):
+    """ Decorator for WifiLedBulb methods, reports how long each call took and whether it
+        succeeded to the bulb's metrics (if set).  A call fails if it raises or returns False.
+        The clock starts once the call's first request holds its rate limiter slot and the
+        bulb lock (see WifiLedBulb.__held), so waiting on the limiter, the background jitter
+        or another thread isn't counted as the controller being slow. """
+    def decorate(func):
+        def wrapper(self, *args, **kwargs):
+            metrics = self.conn.metrics
+            if metrics is None:
+                return func(self, *args, **kwargs)
+            timing = self._timing
+            outer = getattr(timing, 'start', None) #an enclosing timed call's start
+            timing.start = None
+            start = time.time()
+            ok, error = False, None
+            try:
+                result = func(self, *args, **kwargs)
+                ok = result is not False
+                return result
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.observe(op, time.time() - (timing.start or start), ok, error)
+                timing.start = outer
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
 
 class utils:
     @staticmethod
@@ -81,6 +149,12 @@ class utils:
         delay = delay + 1
         return delay
     
+    @staticmethod
+    def appendChecksum(msg):
+        # checksum is the low byte of the sum of every byte in the message
+        msg.append(sum(msg) & 0xFF)
+        return msg
+
     @staticmethod
     def byteToPercent(byte):
         if byte > 255:
@@ -127,10 +201,10 @@ class PresetPattern:
 	
 	@staticmethod
 	def valtostr(pattern):
-		for key, value in PresetPattern.__dict__.iteritems():
-			if type(value) is int and value == pattern:
-				return key.replace("_", " ").title()
-		return None
+		return PresetPattern.names.get(pattern)
+
+# pattern code: display name, built once
+PresetPattern.names = codec.reverseLookup(PresetPattern, lambda key: key.replace("_", " ").title())
 
 class LedTimer():
 	Mo = 0x02
@@ -146,14 +220,11 @@ class LedTimer():
 
 	@staticmethod
 	def dayMaskToStr(mask):
-		for key, value in LedTimer.__dict__.iteritems():
-			if type(value) is int and value == mask:
-				return key
-		return None  
+		return LedTimer.day_names.get(mask)
 
-	def __init__(self, bytes=None):
+	def __init__(self, bytes=None, offset=0):
 		if bytes is not None:
-			self.fromBytes(bytes)
+			self.fromBytes(bytes, offset)
 			return
 			
 		the_time = datetime.datetime.now() + datetime.timedelta(hours=1)  
@@ -252,39 +323,40 @@ class LedTimer():
 		12: warm white level
 		13: 0f = off, f0 = on ?
 	"""		
-	def fromBytes(self, bytes):
+	def fromBytes(self, bytes, offset=0):
 		#utils.dump_bytes(bytes)
+		fields = codec.decodeTimer(bytes, offset)
 		self.red = 0
 		self.green = 0
 		self.blue = 0		
-		if bytes[0] == 0xf0:
+		if fields[0] == 0xf0:
 			self.active = True
 		else:
 			self.active = False
-		self.year = bytes[1]+2000
-		self.month = bytes[2]
-		self.day = bytes[3]
-		self.hour = bytes[4]
-		self.minute = bytes[5]
-		self.repeat_mask = bytes[7]
-		self.pattern_code = bytes[8]
+		self.year = fields[1]+2000
+		self.month = fields[2]
+		self.day = fields[3]
+		self.hour = fields[4]
+		self.minute = fields[5]
+		self.repeat_mask = fields[7]
+		self.pattern_code = fields[8]
 	
 		if self.pattern_code == 0x61:
 			self.mode = "color"
-			self.red = bytes[9]
-			self.green = bytes[10]
-			self.blue = bytes[11]
+			self.red = fields[9]
+			self.green = fields[10]
+			self.blue = fields[11]
 		elif self.pattern_code == 0x00:
 			self.mode ="default"
 		else:
 			self.mode = "preset"
-			self.delay = bytes[9] #same byte as red
+			self.delay = fields[9] #same byte as red
 
-		self.warmth_level = bytes[12]
+		self.warmth_level = fields[12]
 		if self.warmth_level != 0:
 			self.mode = "ww"
 			
-		if bytes[13] == 0xf0:
+		if fields[13] == 0xf0:
 			self.turn_on = True
 		else:
 			self.turn_on = False
@@ -368,51 +440,184 @@ class LedTimer():
 			
 		return txt
 
-class WifiLedBulb():
-    def __init__(self, ipaddr, macaddr, model="",port=5577):
+class BulbConnection():
+    """ Owns the one live socket to a controller.  A failed socket is thrown away and a
+        new one created on the next attempt, with exponential backoff (plus jitter, so
+        a whole fleet doesn't retry in lockstep) between failed connects. """
+    DISCONNECTED = 0
+    CONNECTED = 1
+    BACKOFF = 2
+
+    def __init__(self, ipaddr, port, timeout=5, min_backoff=1., max_backoff=60.):
         self.ipaddr = ipaddr
         self.port = port
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.socket = None
+        self.state = BulbConnection.DISCONNECTED
+        self.failures = 0
+        self.retry_at = 0.
+        self.connects = 0 #connections established, every one after the first is a reconnect
+        # optional object with observe(op, seconds, ok, error=None) and reconnected(),
+        # told about every operation on this controller (see polyMagicHome_metrics)
+        self.metrics = None
+        # optional rate limiter shared by the fleet, see polyMagicHome_limit
+        self.limiter = None
+
+    @property
+    def connected(self):
+        return self.state == BulbConnection.CONNECTED
+
+    def ready(self):
+        """ True if a connect attempt is allowed now """
+        return self.connected or time.time() >= self.retry_at
+
+    def newSocket(self):
+        self.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # notice a dead controller within about a minute instead of the OS default of hours
+        for opt, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, opt):
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+                except socket.error: pass
+        sock.settimeout(self.timeout)
+        self.socket = sock
+        return sock
+
+    def connect(self):
+        if self.connected:
+            return True
+        if not self.ready():
+            return False
+        sock = self.newSocket()
+        start = time.time()
+        try:
+            sock.connect((self.ipaddr, self.port))
+        except socket.error as e:
+            if self.metrics is not None: self.metrics.observe('connect', time.time() - start, False, e)
+            self.failed()
+            return False
+        if self.metrics is not None: self.metrics.observe('connect', time.time() - start, True)
+        self.established()
+        return True
+
+    def established(self):
+        self.state = BulbConnection.CONNECTED
+        self.failures = 0
+        self.retry_at = 0.
+        self.connects += 1
+        if self.connects > 1 and self.metrics is not None:
+            self.metrics.reconnected()
+
+    def failed(self):
+        """ A connect attempt failed, close the socket and back off before the next one """
+        self.close()
+        self.failures += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.time() + delay / 2. + random.uniform(0, delay / 2.)
+        self.state = BulbConnection.BACKOFF
+
+    def reset(self):
+        """ An established connection broke, close it so the next request reconnects straight away """
+        self.close()
+        self.state = BulbConnection.DISCONNECTED
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error: pass
+            try:
+                self.socket.close()
+            except socket.error: pass
+            self.socket = None
+        if self.state == BulbConnection.CONNECTED:
+            self.state = BulbConnection.DISCONNECTED
+
+    def send(self, data):
+        """ Sends data, reconnecting first if needed.  A send on a connection that has
+            gone stale is retried once on a fresh connection. """
+        for attempt in range(2):
+            if not self.connect():
+                raise NotConnected('Not connected to {}, retrying in {:.1f}s'.format(self.ipaddr, max(0, self.retry_at - time.time())))
+            try:
+                self.socket.sendall(data)
+                return
+            except socket.error:
+                self.reset()
+        raise NotConnected('Lost connection to {}'.format(self.ipaddr))
+
+# day mask: name, built once
+LedTimer.day_names = codec.reverseLookup(LedTimer)
+
+class WifiLedBulb(object):
+    def __init__(self, ipaddr, macaddr, model="",port=5577, timeout=5, autoconnect=True):
+        self.ipaddr = ipaddr
+        self.port = port
+        self.timeout = timeout
         self.__isOn = False
         self.color = [0,0,0]
         self.power = 0
+        self.mode = "unknown" #color, ww, preset or custom
+        self.pattern = 0 #preset pattern code in preset mode
+        self.speed = 0 #preset or custom pattern speed, 0-100
         self.macaddr = macaddr
         self.model = model
-        self.connected = False
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect()
+        self.conn = BulbConnection(ipaddr, port, timeout)
+        # held for each write and each request/reply pair so callers on different threads never interleave on the socket
+        self.lock = threading.RLock()
+        # per thread start time of the timed call in progress, see timed()
+        self._timing = threading.local()
+        # receive buffer reused by every read, grown if a longer reply is ever expected
+        self.__rxbuf = bytearray(128)
+        # transmit buffer setRGB packs each color frame into
+        self.__txbuf = bytearray(codec.RGB.size)
         self.__state_str = ""
-        self.refreshState()
+        self.__custom = None #last custom pattern frame uploaded
+        self.updated = None #time the tracked state was last read from, or written to, the controller
+        # with autoconnect off nothing is sent until the first request, which connects on demand
+        if autoconnect:
+            self.connect()
+            self.refreshState()
+
+    @property
+    def connected(self):
+        return self.conn.connected
+
+    @property
+    def socket(self):
+        return self.conn.socket
+
+    @property
+    def metrics(self):
+        return self.conn.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.conn.metrics = metrics
+
+    @property
+    def limiter(self):
+        return self.conn.limiter
+
+    @limiter.setter
+    def limiter(self, limiter):
+        self.conn.limiter = limiter
 
     def connect(self):
-        try:
-            self.socket.connect((self.ipaddr, self.port))
-            self.connected = True
-        except:
-            try:
-                self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
-            except: pass
-            self.connected = False
+        return self.conn.connect()
 
     def disconnect(self):
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-            self.connected = False
-        except: pass
+        self.conn.close()
         
-    def __determineMode(self, ww_level, pattern_code):
-        mode = "unknown"
-        if pattern_code in [ 0x61, 0x62]:
-            if ww_level != 0:
-                mode = "ww"
-            else:
-                mode = "color"
-        elif pattern_code == 0x60:
-            mode = "custom"
-        elif PresetPattern.valid(pattern_code):
-            mode = "preset"
-        return mode
+    def fresh(self, ttl):
+        """ True if the tracked state (color, power) was read or set less than ttl seconds
+            ago on the current connection, so it can be trusted without asking the controller """
+        return self.updated is not None and self.connected and time.time() - self.updated < ttl
 
     def __updatePower(self):
         if self.__isOn:
@@ -420,40 +625,45 @@ class WifiLedBulb():
         else:
             self.power = 0
 
+    @timed('refresh')
     def refreshState(self):
-        msg = bytearray([0x81, 0x8a, 0x8b])
+        msg = self._stateMsg()
         try:
-            self.__write(msg)
-            rx = self.__readResponse(14)
-        except:
-            self.connect()
+            rx = self.__request(msg, 14)
+        except (NotConnected, Throttled):
             return False
+        except (BulbError, socket.error):
+            # __readResponse has already dropped the connection
+            return False
+        return self._processState(rx)
+
+    def _stateMsg(self):
+        return codec.STATE_QUERY
 
-        power_state = rx[2]
+    def _processState(self, rx):
+        is_on, pattern, mode, delay, red, green, blue, ww_level = codec.decodeState(rx)
+        self.updated = time.time()
         power_str = "Unknown power state"
 
-        if power_state == 0x23:
+        if is_on is True:
             self.__isOn = True
             power_str = "ON "
-        elif power_state == 0x24:
+        elif is_on is False:
             self.__isOn = False
             power_str = "OFF"
             
-        pattern = rx[3]
-        ww_level = rx[9]
-        mode = self.__determineMode(ww_level, pattern)
-        delay = rx[5]
         speed = utils.delayToSpeed(delay)
+        self.mode, self.pattern, self.speed = mode, pattern, speed
         
         if mode == "color":
-            self.color = [rx[6],rx[7],rx[8]]
+            self.color = [red,green,blue]
             self.__updatePower()
-            color_str = utils.color_tuple_to_string((rx[6],rx[7],rx[8]))
+            color_str = utils.color_tuple_to_string((red,green,blue))
             mode_str = "Color: {}".format(color_str)
         elif mode == "ww":
             self.color = [0,0,0]
             if self.__isOn:
-                self.power = int(rx[9]/255*100)
+                self.power = utils.byteToPercent(ww_level)
             else:
                 self.power = 0
             mode_str = "Warm White: {}%".format(utils.byteToPercent(ww_level))
@@ -476,10 +686,9 @@ class WifiLedBulb():
         return self.__state_str
 
             
+    @timed('clock')
     def getClock(self):
-        msg = bytearray([0x11, 0x1a, 0x1b, 0x0f])
-        self.__write(msg)
-        rx = self.__readResponse(12)
+        rx = self.__request(codec.CLOCK_QUERY, 12)
         #self.dump_data(rx)
         year =  rx[3] + 2000
         month = rx[4]
@@ -494,87 +703,90 @@ class WifiLedBulb():
             dt = None
         return dt
 
+    @timed('clock')
     def setClock(self):
-        msg = bytearray([0x10, 0x14])
-        now = datetime.datetime.now()
-        msg.append(now.year-2000)
-        msg.append(now.month)
-        msg.append(now.day)
-        msg.append(now.hour)
-        msg.append(now.minute)
-        msg.append(now.second)
-        msg.append(now.isoweekday()) # day of week
-        msg.append(0x00)
-        msg.append(0x0f)
-        self.__write(msg)
+        self.__send(codec.encodeClock(datetime.datetime.now()))
 
+    @timed('power')
     def turnOn(self, on=True):
-        if on:
-            msg = bytearray([0x71, 0x23, 0x0f, 0xa3])
-        else:
-            msg = bytearray([0x71, 0x24, 0x0f, 0xa4])
-            
-        self.__write(msg)
+        msg = self._powerMsg(on)
+        self.__send(msg)
         #print "set bulb {}".format(on)
         #time.sleep(.5)
         #x = self.__readResponse(4)
-        self.__isOn = on
-        self.__updatePower()
+        self._applyPower(on)
          
+    @timed('power')
     def turnOff(self):
-        msg = bytearray([0x71, 0x24, 0x0f, 0xa4])
-        self.__write(msg)
-        self.power = 0
+        msg = self._powerMsg(False)
+        self.__send(msg)
+        self._applyPower(False)
+
+    def _powerMsg(self, on):
+        if on:
+            return codec.POWER_ON
+        else:
+            return codec.POWER_OFF
+
+    def _applyPower(self, on):
+        self.__isOn = on
+        self.__updatePower()
+        self.updated = time.time()
     
+    @timed('warmwhite')
     def setWarmWhite(self, level, persist=True):
-        if persist:
-            msg = bytearray([0x31])
-        else:
-            msg = bytearray([0x41])
-        msg.append(0x00)
-        msg.append(0x00)
-        msg.append(0x00)
-        msg.append(utils.percentToByte(level))
-        msg.append(0x0f)
-        msg.append(0x0f)
-        self.__write(msg)
+        self.__send(codec.encodeWarmWhite(utils.percentToByte(level), persist))
         
+    @timed('rgb')
     def setRGB(self, r,g,b, persist=True):
-        if persist:
-            msg = bytearray([0x31])
-        else:
-            msg = bytearray([0x41])
-        msg.append(r)
-        msg.append(g)
-        msg.append(b)
-        msg.append(0x00) #Warm White Value
-        msg.append(0x00) #Cool White Value
-        msg.append(0x0f) #FALSE (don't use white value)
-        self.__write(msg)
+        # slot first, as __send takes it: waiting on the limiter mustn't hold the bulb lock
+        with self.__slot():
+            with self.lock:
+                self.__held()
+                codec.packRGB(self.__txbuf, 0, r, g, b, persist)
+                self.__writeRaw(self.__txbuf)
+        self._applyRGB(r, g, b)
+
+    def _rgbMsg(self, r, g, b, persist=True):
+        return codec.encodeRGB(r, g, b, persist)
+
+    def _applyRGB(self, r, g, b):
         self.color = [r,g,b]
+        self.mode = "color"
         self.__updatePower()
+        self.updated = time.time()
 
+    def _applyPattern(self, mode, pattern, speed):
+        self.mode, self.pattern, self.speed = mode, pattern, speed
+        self.updated = time.time()
+
+    @timed('preset')
     def setPresetPattern(self, pattern, speed):
+        pattern_set_msg = self._presetMsg(pattern, speed)
+        self.__send(pattern_set_msg)
+        self._applyPattern("preset", pattern, speed)
 
-        PresetPattern.valtostr(pattern)
+    def _presetMsg(self, pattern, speed):
         if not PresetPattern.valid(pattern):
             #print "Pattern must be between 0x25 and 0x38"
             raise Exception
 
         delay = utils.speedToDelay(speed)
         #print "speed {}, delay 0x{:02x}".format(speed,delay)
-        pattern_set_msg = bytearray([0x61])
-        pattern_set_msg.append(pattern)
-        pattern_set_msg.append(delay)
-        pattern_set_msg.append(0x0f)
-
-        self.__write(pattern_set_msg)
+        return codec.encodePreset(pattern, delay)
 
+    @timed('timers')
     def getTimers(self):
-        msg = bytearray([0x22, 0x2a, 0x2b, 0x0f])
-        self.__write(msg)
+        msg = self._timersMsg()
+        resp_len = 88
+        rx = self.__request(msg, resp_len)
+        return self._processTimers(rx)
+
+    def _timersMsg(self):
+        return codec.TIMERS_QUERY
+
+    def _processTimers(self, rx):
         resp_len = 88
-        rx = self.__readResponse(resp_len)
         if len(rx) != resp_len:
             print "response too short!"
             raise Exception
@@ -584,18 +796,16 @@ class WifiLedBulb():
         timer_list = []
         #pass in the 14-byte timer structs 
         for i in range(6):
-          timer_bytes = rx[start:][:14]
-          timer = LedTimer(timer_bytes)
+          timer = LedTimer(rx, start)
           timer_list.append(timer)
           start += 14
           
         return timer_list
                 
+    @timed('timers')
     def sendTimers(self, timer_list):
-        # remove inactive or expired timers from list
-        for t in timer_list:
-            if not t.isActive() or t.isExpired():
-                timer_list.remove(t)
+        # leave out inactive or expired timers, without changing the caller's list
+        timer_list = [t for t in timer_list if t.isActive() and not t.isExpired()]
                 
         # truncate if more than 6
         if len(timer_list) > 6:
@@ -616,13 +826,18 @@ class WifiLedBulb():
         for t in timer_list:
             msg.extend(t.toBytes())
         msg.extend(msg_end)
-        self.__write(msg)
-        
-        # not sure what the resp is, prob some sort of ack?
-        rx = self.__readResponse(1)
-        rx = self.__readResponse(3)
+        utils.appendChecksum(msg)
+        with self.__slot():
+            with self.lock:
+                self.__held()
+                self.__writeRaw(msg)
+
+                # not sure what the resp is, prob some sort of ack?
+                rx = self.__readResponse(1)
+                rx = self.__readResponse(3)
         
-    def setCustomPattern(self, rgb_list, speed, transition_type):
+    @timed('custom')
+    def setCustomPattern(self, rgb_list, speed, transition_type, force=False):
                 
         # truncate if more than 16
         if len(rgb_list) > 16:
@@ -634,73 +849,637 @@ class WifiLedBulb():
             print "no colors, aborting"
             return
         
-        msg = bytearray()
+        msg = codec.encodeCustom(rgb_list, utils.speedToDelay(speed), transition_type)
+        # the controller is already running this exact pattern, uploading it again changes nothing
+        if not force and msg == self.__custom and self.mode == "custom":
+            return
+        self.__send(msg)
+        self.__custom = msg
+        self._applyPattern("custom", 0x60, speed)
+
+    @timed('write')
+    def __writeRaw(self, bytes):
+        self.conn.send(bytes)
+
+    def __send(self, frame):
+        # frame already has its checksum (see flux_led_codec)
+        with self.__slot():
+            with self.lock:
+                self.__held()
+                self.__writeRaw(frame)
+
+    def __request(self, frame, expected):
+        with self.__slot():
+            with self.lock:
+                self.__held()
+                self.__writeRaw(frame)
+                return self.__readResponse(expected)
+
+    def __held(self):
+        """ Starts the timed() clock, once the first request holds its slot and the lock """
+        if getattr(self._timing, 'start', None) is None:
+            self._timing.start = time.time()
+
+    def __slot(self):
+        """ The rate limiter's slot for one request, held until its reply is read.  Taken
+            before the bulb lock, so a poll waiting for a slot never holds up a command. """
+        if self.conn.limiter is None:
+            return UNLIMITED
+        return self.conn.limiter.slot(self.ipaddr, self.timeout)
         
-        first_color = True
-        for rgb in rgb_list:
-            if first_color:
-                lead_byte = 0x51
-                first_color = False
+    @timed('read')
+    def __readResponse(self, expected, timeout=None):
+        """ Reads exactly expected bytes, raising ReadTimeout if they don't all arrive
+            within timeout seconds (default self.timeout) or ShortRead if the
+            connection closes first. """
+        if timeout is None: timeout = self.timeout
+        if len(self.__rxbuf) < expected:
+            self.__rxbuf = bytearray(expected)
+        sock = self.socket
+        if sock is None:
+            raise NotConnected('Not connected to {}'.format(self.ipaddr))
+        view = memoryview(self.__rxbuf)
+        deadline = None if timeout is None else time.time() + timeout
+        received = 0
+        try:
+            while received < expected:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    sock.settimeout(remaining)
+                count = sock.recv_into(view[received:expected])
+                if count == 0:
+                    raise ShortRead('{} closed the connection after {} of {} bytes'.format(self.ipaddr, received, expected))
+                received += count
+        # on any failed read drop the connection, so a late reply isn't read as the answer to the next request
+        except socket.timeout:
+            self.conn.reset()
+            raise ReadTimeout('{} sent {} of {} bytes within {}s'.format(self.ipaddr, received, expected, timeout))
+        except (ShortRead, socket.error):
+            self.conn.reset()
+            raise
+        finally:
+            try:
+                sock.settimeout(self.timeout)
+            except socket.error: pass
+        return self.__rxbuf[:expected]
+    
+class WifiLedFleet():
+    """ Drives a group of WifiLedBulb's from one select() loop.  Exposes the same
+        calls as WifiLedBulb, but every frame goes out at once and replies are
+        collected as they arrive, so a cycle takes as long as the slowest bulb
+        instead of the sum of all of them.  Each call returns a dict keyed by bulb.
+        After each call, latencies holds the seconds each successful bulb took to be
+        sent its frames (and reply, if one was expected). """
+    def __init__(self, bulbs=None, timeout=5):
+        self.bulbs = list(bulbs) if bulbs is not None else []
+        self.timeout = timeout
+        self.latencies = {}
+
+    def add(self, bulb):
+        if bulb not in self.bulbs:
+            self.bulbs.append(bulb)
+
+    def remove(self, bulb):
+        if bulb in self.bulbs:
+            self.bulbs.remove(bulb)
+
+    def refreshState(self, bulbs=None, timeout=None):
+        jobs = [(b, b._stateMsg(), 14) for b in self.__select(bulbs)]
+        results = {}
+        for b, rx in self.__run(jobs, timeout, 'refresh').items():
+            results[b] = b._processState(rx) if rx is not None else False
+        return results
+
+    def setRGB(self, r, g, b, persist=True, bulbs=None, timeout=None):
+        return self.setColors(dict((bulb, (r, g, b)) for bulb in self.__select(bulbs)), None, persist, timeout)
+
+    def setColors(self, colors, on=None, persist=True, timeout=None):
+        """ Sends each bulb its own color, colors is a dict of bulb: (r, g, b).  If on is
+            True or False a power frame follows the color frame in the same write. """
+        jobs = []
+        for bulb, rgb in colors.items():
+            msgs = [bulb._rgbMsg(rgb[0], rgb[1], rgb[2], persist)]
+            if on is not None: msgs.append(bulb._powerMsg(on))
+            jobs.append((bulb, msgs, 0))
+        results = {}
+        for bulb, rx in self.__run(jobs, timeout, 'rgb').items():
+            if rx is not None:
+                bulb._applyRGB(*colors[bulb])
+                if on is not None: bulb._applyPower(on)
+            results[bulb] = rx is not None
+        return results
+
+    def turnOn(self, on=True, bulbs=None, timeout=None):
+        jobs = [(b, b._powerMsg(on), 0) for b in self.__select(bulbs)]
+        results = {}
+        for b, rx in self.__run(jobs, timeout, 'power').items():
+            if rx is not None: b._applyPower(on)
+            results[b] = rx is not None
+        return results
+
+    def turnOff(self, bulbs=None, timeout=None):
+        return self.turnOn(False, bulbs, timeout)
+
+    def setPresetPattern(self, pattern, speed, bulbs=None, timeout=None):
+        jobs = [(b, b._presetMsg(pattern, speed), 0) for b in self.__select(bulbs)]
+        return dict((b, rx is not None) for b, rx in self.__run(jobs, timeout, 'preset').items())
+
+    def getTimers(self, bulbs=None, timeout=None):
+        jobs = [(b, b._timersMsg(), 88) for b in self.__select(bulbs)]
+        results = {}
+        for b, rx in self.__run(jobs, timeout, 'timers').items():
+            results[b] = b._processTimers(rx) if rx is not None else None
+        return results
+
+    def __select(self, bulbs):
+        if bulbs is None:
+            return list(self.bulbs)
+        return list(bulbs)
+
+    def __run(self, jobs, timeout=None, op=None):
+        """ jobs is a list of (bulb, frame or list of frames, expected reply length).  Returns {bulb: reply}
+            where the reply is a bytearray (empty when no reply is expected) or None
+            if the bulb failed or missed the deadline.  op names the operation in each
+            bulb's metrics. """
+        if timeout is None: timeout = self.timeout
+        # take every bulb's lock (in a fixed order so two runs can't deadlock) for the whole run
+        locked = sorted(set(job[0] for job in jobs), key=id)
+        for bulb in locked:
+            bulb.lock.acquire()
+        try:
+            results = self.__runLocked(jobs, timeout)
+        finally:
+            for bulb in locked:
+                bulb.lock.release()
+        if op is not None:
+            elapsed = time.time() - self.__started
+            for bulb, rx in results.items():
+                if bulb.metrics is None: continue
+                if rx is not None:
+                    bulb.metrics.observe(op, self.latencies[bulb], True)
+                else:
+                    bulb.metrics.observe(op, elapsed, False, self.__errors.get(bulb))
+        return results
+
+    def __runLocked(self, jobs, timeout):
+        start = self.__started = time.time()
+        deadline = start + timeout
+        results = {}
+        pending = {}
+        queued = [] #jobs waiting for their rate limiter slot
+        self.latencies = {}
+        self.__errors = {} #bulb: what went wrong, for the metrics
+        for bulb, msgs, expected in jobs:
+            results[bulb] = None
+            if not isinstance(msgs, list): msgs = [msgs]
+            out = bytearray()
+            for msg in msgs:
+                out.extend(msg)
+            job = {'bulb': bulb, 'out': out, 'sent': 0,
+                   'expected': expected, 'rx': bytearray(expected), 'received': 0,
+                   'connecting': False, 'limited': False}
+            if not bulb.conn.ready():
+                # still backing off after a failed connect
+                self.__errors[bulb] = NotConnected('Not connected to {}'.format(bulb.ipaddr))
+                continue
+            queued.append(job)
+
+        while pending or queued:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # start every queued job the rate limiter has a slot for, in order
+            for job in list(queued):
+                limiter = job['bulb'].conn.limiter
+                if limiter is not None:
+                    if not limiter.try_acquire(job['bulb'].ipaddr):
+                        continue
+                    job['limited'] = True
+                queued.remove(job)
+                if self.__start(job):
+                    pending[job['bulb'].socket.fileno()] = job
+            wait = min(remaining, 0.01) if queued else remaining
+            if not pending:
+                time.sleep(wait)
+                continue
+            rlist = [fd for fd, j in pending.items() if not j['connecting'] and j['sent'] >= len(j['out'])]
+            wlist = [fd for fd, j in pending.items() if j['connecting'] or j['sent'] < len(j['out'])]
+            try:
+                readable, writable, _ = select.select(rlist, wlist, [], wait)
+            except select.error as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd in writable:
+                job = pending[fd]
+                bulb = job['bulb']
+                try:
+                    if job['connecting']:
+                        err = bulb.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err != 0:
+                            raise socket.error(err, errno.errorcode.get(err, str(err)))
+                        job['connecting'] = False
+                        bulb.conn.established()
+                    job['sent'] += bulb.socket.send(job['out'][job['sent']:])
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): continue
+                    self.__fail(job, e)
+                    del pending[fd]
+                    continue
+                if job['sent'] >= len(job['out']) and job['expected'] == 0:
+                    results[bulb] = job['rx']
+                    self.latencies[bulb] = time.time() - start
+                    self.__release(job)
+                    del pending[fd]
+            for fd in readable:
+                job = pending[fd]
+                bulb = job['bulb']
+                try:
+                    count = bulb.socket.recv_into(memoryview(job['rx'])[job['received']:])
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): continue
+                    count = 0
+                if count == 0:
+                    # peer closed the connection
+                    self.__fail(job, ShortRead('{} closed the connection'.format(bulb.ipaddr)))
+                    del pending[fd]
+                    continue
+                job['received'] += count
+                if job['received'] >= job['expected']:
+                    results[bulb] = job['rx']
+                    self.latencies[bulb] = time.time() - start
+                    self.__release(job)
+                    del pending[fd]
+
+        # anything left missed the deadline, drop the connection so a late reply
+        # isn't mistaken for the answer to the next request
+        for job in pending.values():
+            self.__fail(job, ReadTimeout('{} missed the deadline'.format(job['bulb'].ipaddr)))
+        for job in queued:
+            self.__errors[job['bulb']] = Throttled('No request slot for {} within {}s'.format(job['bulb'].ipaddr, timeout))
+        for bulb in results:
+            if bulb.connected:
+                try:
+                    bulb.socket.settimeout(bulb.timeout)
+                except socket.error:
+                    bulb.conn.reset()
+        return results
+
+    def __start(self, job):
+        """ Connects (without blocking) if needed, returns False if that failed outright """
+        bulb = job['bulb']
+        try:
+            if not bulb.connected:
+                job['connecting'] = True
+                sock = bulb.conn.newSocket()
+                sock.setblocking(0)
+                err = sock.connect_ex((bulb.ipaddr, bulb.port))
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                    raise socket.error(err, errno.errorcode.get(err, str(err)))
             else:
-                lead_byte = 0
-            r,g,b = rgb
-            msg.extend(bytearray([lead_byte, r,g,b]))
-        
-        # pad out empty slots
-        if len(rgb_list) != 16:
-            for i in range(16-len(rgb_list)):
-                msg.extend(bytearray([0, 1, 2, 3]))
-                
-        msg.append(0x00)
-        msg.append(utils.speedToDelay(speed))
-        
-        if transition_type =="gradual":
-            msg.append(0x3a)
-        elif transition_type =="jump":
-            msg.append(0x3b)
-        elif transition_type =="strobe":
-            msg.append(0x3c)
+                bulb.socket.setblocking(0)
+        except socket.error as e:
+            self.__fail(job, e)
+            return False
+        return True
+
+    def __release(self, job):
+        if job['limited']:
+            job['limited'] = False
+            job['bulb'].conn.limiter.release(job['bulb'].ipaddr)
+
+    def __fail(self, job, error=None):
+        self.__errors[job['bulb']] = error
+        self.__release(job)
+        if job['connecting']:
+            job['bulb'].conn.failed()
         else:
-            #unknown transition string: using 'gradual'
-            msg.append(0x3a)
-        msg.append(0xff)
-        msg.append(0x0f)
+            job['bulb'].conn.reset()
 
-        self.__write(msg)
+class BulbReactor(object):
+    """ One thread doing the reading for any number of WifiLedBulb's.  Whatever arrives on
+        a bulb's socket while nobody is waiting for a reply (acks, state frames the
+        controller pushes, late replies) is read straight away instead of sitting in the
+        kernel buffer, state frames update the bulb and on_state(bulb) is called.
+        query(bulb, callback) sends a state query without blocking the caller, the reply
+        is parsed here and callback(bulb, ok) is called, on this thread, once it arrives
+        or the bulb times out.
+        A bulb's socket is only read while its lock is free, the blocking request/reply
+        calls (refreshState etc.) keep reading their own replies.  A query holds the
+        bulb's lock, and its rate limiter slot, until it completes.  Queries are
+        background traffic: like the blocking background requests, each one starts
+        after a random delay of up to the rate limiter's jitter, so a poll's queries
+        don't reach every controller at the same instant. """
+    IDLE_WAIT = 1. #longest poll() wait when nothing is due
+    BUSY_WAIT = 0.005 #poll() wait while a busy bulb's socket or a query is waiting
 
-    def __writeRaw(self, bytes):
+    def __init__(self, timeout=5, logger=None):
+        self.timeout = timeout
+        self.logger = logger #callback failures are logged here, or to stderr without one
+        self._entries = {} #bulb: entry dict, see add()
+        self._fds = {} #registered fd: entry
+        self._blocked = {} #fd: entry, not polled for input while its bulb is busy
+        self._requests = [] #(due, bulb, callback) not started yet
+        self._lock = threading.Lock()
+        self._poller = select.poll()
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller.register(self._wake_r, select.POLLIN)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.__loop, name='flux_led-reactor')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.__wake()
+        if self._thread is not None:
+            self._thread.join(self.IDLE_WAIT * 2)
+
+    def add(self, bulb, on_state=None):
+        with self._lock:
+            if bulb not in self._entries:
+                self._entries[bulb] = {'bulb': bulb, 'on_state': on_state, 'sock': None, 'fd': None,
+                                       'rx': bytearray(), 'query': None}
+            else:
+                self._entries[bulb]['on_state'] = on_state
+        self.__wake()
+
+    def remove(self, bulb):
+        with self._lock:
+            entry = self._entries.pop(bulb, None)
+        if entry is not None:
+            entry['removed'] = True
+        self.__wake()
+
+    def query(self, bulb, callback=None):
+        """ Queues a state query, callback(bulb, ok) is called on the reactor thread """
+        limiter = bulb.conn.limiter
+        due = time.time()
+        if limiter is not None and limiter.jitter > 0:
+            due += random.uniform(0, limiter.jitter)
+        with self._lock:
+            if bulb not in self._entries:
+                self._entries[bulb] = {'bulb': bulb, 'on_state': None, 'sock': None, 'fd': None,
+                                       'rx': bytearray(), 'query': None}
+            self._requests.append((due, bulb, callback))
+        self.__wake()
+
+    def __wake(self):
         try:
-            self.socket.send(bytes)
-        except:
+            os.write(self._wake_w, b'x')
+        except OSError: pass
+
+    def __loop(self):
+        while self._running:
+            now = time.time()
+            self.__sync()
+            retry = self.__startQueries(now)
+            wait = self.IDLE_WAIT
+            for entry in self._entries.values():
+                if entry['query'] is not None:
+                    wait = min(wait, max(0, entry['query']['deadline'] - now))
+            if retry is not None:
+                wait = min(wait, retry)
+            if self._blocked:
+                wait = min(wait, self.BUSY_WAIT)
             try:
-                self.socket.connect((self.ipaddr, self.port))
-                self.socket.send(bytes)
-            except: pass #communication with these MagicHome LED Controllers can be spotty, unfortunately.  Need to add some better error handling, this is temporary to get up and running
-
-    def __write(self, bytes):
-        # calculate checksum of byte array and add to end
-        csum = sum(bytes) & 0xFF
-        bytes.append(csum)
-        #print "-------------",utils.dump_bytes(bytes)
-        self.__writeRaw(bytes)
-        #time.sleep(.4)		
-        
-    def __readResponse(self, expected):
-        remaining = expected
-        rx = bytearray()
-        while remaining > 0:
-            chunk = self.__readRaw(remaining)
-            remaining -= len(chunk)
-            rx.extend(chunk)
-        return rx
-            
-    def __readRaw(self, byte_count=1024):
+                events = self._poller.poll(int(wait * 1000) + 1)
+            except select.error as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                entry = self._fds.get(fd)
+                if entry is None:
+                    self.__unregister(fd)
+                    continue
+                if event & select.POLLNVAL:
+                    self.__unregister(fd)
+                    entry['sock'] = entry['fd'] = None
+                    continue
+                query = entry['query']
+                if event & select.POLLOUT and query is not None and query['connecting']:
+                    self.__connected(entry)
+                elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    self.__read(entry)
+            self.__expire(time.time())
+
+    def __register(self, entry, sock):
+        fd = sock.fileno()
+        query = entry['query']
+        events = select.POLLOUT if query is not None and query['connecting'] else select.POLLIN
         try:
-            rx = self.socket.recv(byte_count)
-            return rx
-        except: pass
-    
+            self._poller.register(fd, events)
+        except (IOError, OSError, ValueError):
+            return
+        entry['sock'], entry['fd'] = sock, fd
+        entry['rx'] = bytearray()
+        self._fds[fd] = entry
+
+    def __unregister(self, fd):
+        self._fds.pop(fd, None)
+        self._blocked.pop(fd, None)
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, ValueError): pass
+
+    def __sync(self):
+        """ Keeps the registered fds in step with each bulb's current socket, which
+            changes whenever it reconnects """
+        with self._lock:
+            entries = self._entries.values()
+        live = set()
+        for entry in entries:
+            sock = entry['bulb'].conn.socket
+            if sock is not entry['sock']:
+                if entry['fd'] is not None and self._fds.get(entry['fd']) is entry:
+                    self.__unregister(entry['fd'])
+                entry['sock'] = entry['fd'] = None
+                if sock is not None:
+                    self.__register(entry, sock)
+            if entry['fd'] is not None:
+                live.add(entry['fd'])
+        for fd in self._fds.keys():
+            if fd not in live: self.__unregister(fd) #removed bulbs
+        # give busy bulbs another chance to be read
+        for fd in self._blocked.keys():
+            entry = self._blocked.pop(fd)
+            try:
+                self._poller.modify(fd, select.POLLIN)
+            except (IOError, OSError, ValueError): pass
+
+    def __startQueries(self, now):
+        """ Starts every queued query that is due and whose bulb and rate limiter slot are
+            free, returns the seconds until those left waiting should be tried again, or
+            None if there are none """
+        with self._lock:
+            requests, self._requests = self._requests, []
+        left = []
+        retry = None
+        for due, bulb, callback in requests:
+            if due > now:
+                left.append((due, bulb, callback))
+                retry = min(retry, due - now) if retry is not None else due - now
+                continue
+            entry = self._entries.get(bulb)
+            if entry is None:
+                self.__call(callback, bulb, False)
+                continue
+            if entry['query'] is not None:
+                entry['query']['callbacks'].append(callback) #already on its way
+                continue
+            if not bulb.lock.acquire(False):
+                left.append((due, bulb, callback))
+                retry = min(retry, self.BUSY_WAIT) if retry is not None else self.BUSY_WAIT
+                continue
+            limiter = bulb.conn.limiter
+            if limiter is not None and not limiter.try_acquire(bulb.ipaddr, 1):
+                bulb.lock.release()
+                left.append((due, bulb, callback))
+                retry = min(retry, self.BUSY_WAIT) if retry is not None else self.BUSY_WAIT
+                continue
+            entry['query'] = {'callbacks': [callback], 'start': now, 'deadline': now + self.timeout,
+                              'limited': limiter is not None, 'connecting': False}
+            if not bulb.conn.ready():
+                self.__finish(entry, False, NotConnected('Not connected to {}'.format(bulb.ipaddr)))
+            elif bulb.connected:
+                self.__send(entry)
+            else:
+                try:
+                    sock = bulb.conn.newSocket()
+                    sock.setblocking(0)
+                    err = sock.connect_ex((bulb.ipaddr, bulb.port))
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        raise socket.error(err, errno.errorcode.get(err, str(err)))
+                except socket.error as e:
+                    bulb.conn.failed()
+                    self.__finish(entry, False, e)
+                    continue
+                entry['query']['connecting'] = True
+                if entry['fd'] is not None: self.__unregister(entry['fd'])
+                self.__register(entry, sock)
+        if left:
+            with self._lock:
+                self._requests[:0] = left
+        return retry
+
+    def __connected(self, entry):
+        bulb = entry['bulb']
+        sock = entry['sock']
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            bulb.conn.failed()
+            self.__finish(entry, False, socket.error(err, errno.errorcode.get(err, str(err))))
+            return
+        bulb.conn.established()
+        sock.settimeout(bulb.timeout)
+        entry['query']['connecting'] = False
+        self._poller.modify(entry['fd'], select.POLLIN)
+        self.__send(entry)
+
+    def __send(self, entry):
+        bulb = entry['bulb']
+        try:
+            bulb.socket.sendall(codec.STATE_QUERY)
+        except socket.error as e:
+            bulb.conn.reset()
+            self.__finish(entry, False, e)
+
+    def __read(self, entry):
+        bulb = entry['bulb']
+        owned = entry['query'] is not None #a query holds the bulb's lock already
+        if not owned and not bulb.lock.acquire(False):
+            # someone is waiting on a reply of their own, leave it to them for now
+            try:
+                self._poller.modify(entry['fd'], 0)
+                self._blocked[entry['fd']] = entry
+            except (IOError, OSError, ValueError): pass
+            return
+        try:
+            try:
+                data = entry['sock'].recv(4096, getattr(socket, 'MSG_DONTWAIT', 0))
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+                data = b''
+            if not data:
+                # closed by the controller (or another client took over)
+                self.__unregister(entry['fd'])
+                entry['sock'] = entry['fd'] = None
+                bulb.conn.reset()
+                if entry['query'] is not None:
+                    self.__finish(entry, False, ShortRead('{} closed the connection'.format(bulb.ipaddr)))
+                return
+            entry['rx'].extend(data)
+            self.__parse(entry)
+        finally:
+            if not owned: bulb.lock.release()
+
+    def __parse(self, entry):
+        rx = entry['rx']
+        bulb = entry['bulb']
+        while rx:
+            length = codec.replyLength(rx)
+            if length is None or len(rx) < (length or 1):
+                break
+            if length == 0 or (rx[0] == 0x81 and not codec.validState(rx)):
+                del rx[0] #not the start of a reply we know, resync
+                continue
+            frame = rx[:length]
+            del rx[:length]
+            if frame[0] != 0x81:
+                continue #clock or timer reply nobody is waiting for
+            bulb._processState(frame)
+            if entry['query'] is not None:
+                self.__finish(entry, True)
+            elif entry['on_state'] is not None:
+                self.__call(entry['on_state'], bulb)
+
+    def __expire(self, now):
+        for entry in list(self._entries.values()):
+            query = entry['query']
+            if query is None or now < query['deadline']: continue
+            bulb = entry['bulb']
+            if query['connecting']:
+                bulb.conn.failed()
+            else:
+                bulb.conn.reset()
+            self.__finish(entry, False, ReadTimeout('{} sent no state within {}s'.format(bulb.ipaddr, self.timeout)))
+
+    def __finish(self, entry, ok, error=None):
+        query, entry['query'] = entry['query'], None
+        bulb = entry['bulb']
+        if query['limited']:
+            bulb.conn.limiter.release(bulb.ipaddr)
+        bulb.lock.release()
+        if bulb.metrics is not None:
+            bulb.metrics.observe('refresh', time.time() - query['start'], ok, error)
+        for callback in query['callbacks']:
+            self.__call(callback, bulb, ok)
+
+    def __call(self, callback, *args):
+        if callback is None: return
+        try:
+            callback(*args)
+        except Exception as e:
+            # a broken callback mustn't take the reactor down with it
+            if self.logger is not None:
+                self.logger.exception('BulbReactor callback failed: %s', str(e))
+            else:
+                traceback.print_exc()
+
 class BulbScanner():
+    # every controller answers a discovery request at once, a large fleet's replies
+    # overflow the default receive buffer (the kernel caps this at net.core.rmem_max)
+    RCVBUF = 1 << 20
+
     def __init__(self):
         self.found_bulbs = []
     
@@ -714,46 +1493,260 @@ class BulbScanner():
     def getBulbInfo(self):
         return self.found_bulbs	
     
-    def scan(self, timeout=10):
-        
+    def scan(self, timeout=10, expected=None, quiet=None, address='<broadcast>'):
+        response_list = list(self.scanIter(timeout, expected, quiet, address))
+        self.found_bulbs = response_list
+        return response_list
+
+    def probe(self, addresses, timeout=1):
+        return list(self.probeIter(addresses, timeout))
+
+    def probeIter(self, addresses, timeout=1):
+        """ Sends the discovery request straight to each address, so it works where
+            broadcasts are filtered, and yields each controller that replies within
+            timeout seconds. """
+        DISCOVERY_PORT = 48899
+        msg = "HF-A11ASSISTHREAD"
+
+        waiting = set(addresses)
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        try:
+            for ipaddr in waiting:
+                try:
+                    sock.sendto(msg, (ipaddr, DISCOVERY_PORT))
+                except socket.error: pass
+            quit_time = time.time() + timeout
+            while waiting:
+                remaining = quit_time - time.time()
+                if remaining <= 0:
+                    return
+                sock.settimeout(remaining)
+                try:
+                    data, addr = sock.recvfrom(64)
+                except socket.timeout:
+                    return
+                fields = data.split(',')
+                if len(fields) < 3 or fields[0] not in waiting:
+                    continue
+                waiting.discard(fields[0])
+                item = dict()
+                item['ipaddr'] = fields[0]
+                item['id'] = fields[1]
+                item['model'] = fields[2]
+                yield item
+        finally:
+            sock.close()
+
+    @staticmethod
+    def hosts(network):
+        """ Host addresses of network: a CIDR ("192.168.4.0/22"), a single address or the
+            name of a local interface (Linux only), whose own subnet is used.  Raises
+            ValueError for anything else, or for a network larger than a /16. """
+        try:
+            if '/' in network:
+                addr, bits = network.split('/', 1)
+                bits = int(bits)
+            elif network.replace('.', '').isdigit():
+                addr, bits = network, 32
+            else:
+                addr, bits = BulbScanner.interfaceNetwork(network)
+            base = struct.unpack('>I', socket.inet_aton(addr))[0]
+        except (ValueError, socket.error):
+            raise ValueError('Not a network, address or interface: {}'.format(network))
+        if not 16 <= bits <= 32:
+            raise ValueError('Network {} is too large to sweep, /16 at most'.format(network))
+        mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+        first, size = base & mask, 1 << (32 - bits)
+        if bits < 31:
+            first, size = first + 1, size - 2 #leave out the network and broadcast addresses
+        return [socket.inet_ntoa(struct.pack('>I', a)) for a in xrange(first, first + size)]
+
+    @staticmethod
+    def interfaceNetwork(name):
+        """ (address, prefix length) of a local interface """
+        try:
+            import fcntl
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                ifreq = struct.pack('256s', str(name)[:15])
+                addr = fcntl.ioctl(sock.fileno(), 0x8915, ifreq)[20:24] #SIOCGIFADDR
+                mask = fcntl.ioctl(sock.fileno(), 0x891b, ifreq)[20:24] #SIOCGIFNETMASK
+            finally:
+                sock.close()
+        except (ImportError, IOError, socket.error):
+            raise ValueError('No IPv4 interface {}'.format(name))
+        return socket.inet_ntoa(addr), bin(struct.unpack('>I', mask)[0]).count('1')
+
+    def sweep(self, networks, timeout=1, concurrency=256, port=5577):
+        return list(self.sweepIter(networks, timeout, concurrency, port))
+
+    def sweepIter(self, networks, timeout=1, concurrency=256, port=5577):
+        """ Finds controllers where broadcasts don't reach: sends the discovery request to
+            every host of networks (see hosts()) at once and probes each one's TCP port,
+            at most concurrency connects in flight, each given timeout seconds.  A host
+            whose port is open but whose discovery reply hasn't come is asked again.
+            Yields each controller (dict of ipaddr, id and model) as its reply arrives,
+            then any host with the port open that never replied, with id None. """
+        DISCOVERY_PORT = 48899
+        msg = "HF-A11ASSISTHREAD"
+
+        addresses = []
+        for network in networks:
+            addresses.extend(BulbScanner.hosts(network))
+        pending = list(reversed(sorted(set(addresses), key=socket.inet_aton)))
+        targets = set(pending)
+        found = set() #addresses that replied to discovery
+        seen = set() #controller ids yielded
+        alive = [] #addresses with the TCP port open
+        connecting = {} #fd: (socket, ipaddr, deadline)
+        poller = select.poll()
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        try:
+            for ipaddr in pending:
+                try:
+                    udp.sendto(msg, (ipaddr, DISCOVERY_PORT))
+                except socket.error: pass
+            udp.setblocking(0)
+            poller.register(udp, select.POLLIN)
+            # replies may come up to timeout seconds after the last request
+            quiet_until = time.time() + timeout
+            while True:
+                now = time.time()
+                while pending and len(connecting) < concurrency:
+                    ipaddr = pending.pop()
+                    try:
+                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    except socket.error:
+                        if not connecting: raise
+                        pending.append(ipaddr) #out of file descriptors, wait for some to close
+                        break
+                    sock.setblocking(0)
+                    err = sock.connect_ex((ipaddr, port))
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        continue
+                    connecting[sock.fileno()] = (sock, ipaddr, now + timeout)
+                    poller.register(sock, select.POLLOUT)
+                if not pending and not connecting and now >= quiet_until:
+                    break
+                deadline = min([d for s, a, d in connecting.values()] or [quiet_until])
+                try:
+                    events = poller.poll(max(0, int((deadline - now) * 1000)) + 1)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR: continue
+                    raise
+                now = time.time()
+                for fd, event in events:
+                    if fd == udp.fileno():
+                        while True:
+                            try:
+                                data, addr = udp.recvfrom(64)
+                            except socket.error:
+                                break
+                            fields = data.split(',')
+                            if len(fields) < 3 or fields[0] not in targets:
+                                continue
+                            found.add(fields[0])
+                            if fields[1] in seen: continue
+                            seen.add(fields[1])
+                            item = dict()
+                            item['ipaddr'] = fields[0]
+                            item['id'] = fields[1]
+                            item['model'] = fields[2]
+                            self.found_bulbs.append(item)
+                            yield item
+                        continue
+                    sock, ipaddr, d = connecting.pop(fd)
+                    poller.unregister(fd)
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        alive.append(ipaddr)
+                        if ipaddr not in found:
+                            # a controller, but its discovery reply got lost: ask again
+                            try:
+                                udp.sendto(msg, (ipaddr, DISCOVERY_PORT))
+                            except socket.error: pass
+                            quiet_until = max(quiet_until, now + timeout)
+                    sock.close()
+                for fd, (sock, ipaddr, d) in connecting.items():
+                    if d <= now:
+                        del connecting[fd]
+                        poller.unregister(fd)
+                        sock.close()
+            for ipaddr in alive:
+                if ipaddr not in found:
+                    yield {'ipaddr': ipaddr, 'id': None, 'model': ''}
+        finally:
+            for sock, ipaddr, d in connecting.values():
+                sock.close()
+            udp.close()
+
+    def scanIter(self, timeout=10, expected=None, quiet=None, address='<broadcast>'):
+        """ Broadcasts discovery requests and yields each controller (dict of ipaddr,
+            id and model) the first time it replies.  Stops after timeout seconds, once
+            expected unique controllers have replied, or once no new controller has
+            replied for quiet seconds, whichever comes first.  address is where the
+            request goes, a subnet's broadcast address (or a simulator) instead of the
+            default route's. """
         DISCOVERY_PORT = 48899
     
         sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
         sock.bind(('', DISCOVERY_PORT))
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         
         msg = "HF-A11ASSISTHREAD"
         
         # set the time at which we will quit the search
-        quit_time = time.time() + timeout
-
-        response_list = []
-        # outer loop for query send
-        while True:
-            if time.time() > quit_time:
-                break			
-            # send out a broadcast query
-            sock.sendto(msg, ('<broadcast>', DISCOVERY_PORT))
+        start = time.time()
+        quit_time = start + timeout
+        last_new = start
+
+        seen = set()
+        self.found_bulbs = []
+        try:
+            # outer loop for query send
+            while time.time() < quit_time:
+                # send out a broadcast query
+                sock.sendto(msg, (address, DISCOVERY_PORT))
+                resend_time = time.time() + 1
             
-            # inner loop waiting for responses
-            while True:
-                
-                sock.settimeout(1)
-                try:
-                    data, addr = sock.recvfrom(64)
-                except socket.timeout:
-                    data = None
-                    if time.time() > quit_time:
+                # inner loop waiting for responses until it's time to broadcast again
+                while True:
+                    now = time.time()
+                    if now >= quit_time:
+                        return
+                    if quiet is not None and now - last_new >= quiet:
+                        return
+                    if now >= resend_time:
                         break
+                    wait = min(resend_time, quit_time) - now
+                    if quiet is not None:
+                        wait = min(wait, last_new + quiet - now)
+                    sock.settimeout(max(wait, 0.01))
+                    try:
+                        data, addr = sock.recvfrom(64)
+                    except socket.timeout:
+                        continue
     
-                if data is not None and data != msg:
+                    if data == msg:
+                        continue
+                    fields = data.split(',')
+                    if len(fields) < 3 or fields[1] in seen:
+                        continue
                     # tuples of IDs and IP addresses
+                    seen.add(fields[1])
+                    last_new = time.time()
                     item = dict()
-                    item['ipaddr'] = data.split(',')[0]
-                    item['id'] = data.split(',')[1]
-                    item['model'] = data.split(',')[2]
-                    response_list.append(item)
-
-        self.found_bulbs = response_list
-        return response_list
+                    item['ipaddr'] = fields[0]
+                    item['id'] = fields[1]
+                    item['model'] = fields[2]
+                    self.found_bulbs.append(item)
+                    yield item
+                    if expected is not None and len(seen) >= expected:
+                        return
+        finally:
+            sock.close()
 #=========================================================================
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Frame encoders and decoders for the MagicHome/flux_led TCP protocol, kept apart from
+WifiLedBulb so the hot path (streaming color frames to many controllers) doesn't build
+each frame a byte at a time.
+* Constant frames are checksummed once, at import
+* Encoders pack straight into a caller's (reusable) buffer with struct.pack_into
+* Decoders read the 14 byte state reply and timer structs in one pass and look the
+  mode and power state up in tables
+"""
+import struct
+
+def checksum(frame, length=None):
+    if length is None: length = len(frame)
+    return sum(frame[:length]) & 0xFF
+
+def _constant(*payload):
+    frame = bytearray(payload)
+    frame.append(checksum(frame))
+    return bytes(frame)
+
+# Constant frames, checksum included
+STATE_QUERY = _constant(0x81, 0x8a, 0x8b)
+POWER_ON = _constant(0x71, 0x23, 0x0f)
+POWER_OFF = _constant(0x71, 0x24, 0x0f)
+CLOCK_QUERY = _constant(0x11, 0x1a, 0x1b, 0x0f)
+TIMERS_QUERY = _constant(0x22, 0x2a, 0x2b, 0x0f)
+
+# Encoders.  Each packX writes a complete frame (checksum included) into buf at offset
+# and returns the frame length, each encodeX returns a new frame.
+RGB = struct.Struct('8B')
+PRESET = struct.Struct('5B')
+CLOCK = struct.Struct('12B')
+
+def packRGB(buf, offset, r, g, b, persist=True):
+    opcode = 0x31 if persist else 0x41
+    # 0x00 warm white, 0x00 cool white, 0x0f don't use the white value
+    RGB.pack_into(buf, offset, opcode, r, g, b, 0x00, 0x00, 0x0f, (opcode + r + g + b + 0x0f) & 0xFF)
+    return RGB.size
+
+def encodeRGB(r, g, b, persist=True):
+    buf = bytearray(RGB.size)
+    packRGB(buf, 0, r, g, b, persist)
+    return buf
+
+def packWarmWhite(buf, offset, level, persist=True):
+    """ level is 0-255 """
+    opcode = 0x31 if persist else 0x41
+    RGB.pack_into(buf, offset, opcode, 0x00, 0x00, 0x00, level, 0x0f, 0x0f, (opcode + level + 0x1e) & 0xFF)
+    return RGB.size
+
+def encodeWarmWhite(level, persist=True):
+    buf = bytearray(RGB.size)
+    packWarmWhite(buf, 0, level, persist)
+    return buf
+
+def packPreset(buf, offset, pattern, delay):
+    PRESET.pack_into(buf, offset, 0x61, pattern, delay, 0x0f, (0x70 + pattern + delay) & 0xFF)
+    return PRESET.size
+
+def encodePreset(pattern, delay):
+    buf = bytearray(PRESET.size)
+    packPreset(buf, 0, pattern, delay)
+    return buf
+
+# custom pattern transition byte by name
+TRANSITIONS = {'gradual': 0x3a, 'jump': 0x3b, 'strobe': 0x3c}
+CUSTOM_SLOTS = 16
+
+def encodeCustom(colors, delay, transition='gradual'):
+    """ Custom pattern frame for up to 16 (r, g, b) colors, unknown transitions are gradual """
+    buf = bytearray(0x51 if i == 0 else 0 for i in range(CUSTOM_SLOTS * 4))
+    for i, rgb in enumerate(colors[:CUSTOM_SLOTS]):
+        buf[i * 4 + 1:i * 4 + 4] = bytearray(rgb)
+    for i in range(len(colors), CUSTOM_SLOTS):
+        buf[i * 4 + 1:i * 4 + 4] = bytearray([1, 2, 3]) #empty slot
+    buf.extend(bytearray([0x00, delay, TRANSITIONS.get(transition, 0x3a), 0xff, 0x0f]))
+    buf.append(checksum(buf))
+    return buf
+
+def encodeClock(dt):
+    buf = bytearray(CLOCK.size)
+    fields = (0x10, 0x14, dt.year - 2000, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.isoweekday(), 0x00, 0x0f)
+    CLOCK.pack_into(buf, 0, *(fields + (sum(fields) & 0xFF,)))
+    return buf
+
+# Decoders
+TIMER = struct.Struct('14B')
+POWER = {0x23: True, 0x24: False}
+
+# mode by pattern byte, 0x61/0x62 are "ww" instead of "color" when the warm white level is set
+MODES = ['unknown'] * 256
+MODES[0x60] = 'custom'
+MODES[0x61] = MODES[0x62] = 'color'
+for _pattern in range(0x25, 0x39):
+    MODES[_pattern] = 'preset'
+
+def decodeState(rx):
+    """ Returns (is_on, pattern, mode, delay, r, g, b, ww_level) from a 14 byte state reply.
+        is_on is None if the power byte isn't recognised. """
+    # indexing a bytearray directly beats struct.unpack_from for the 8 bytes used here
+    pattern = rx[3]
+    ww = rx[9]
+    mode = MODES[pattern]
+    if ww != 0 and mode == 'color':
+        mode = 'ww'
+    return POWER.get(rx[2]), pattern, mode, rx[5], rx[6], rx[7], rx[8], ww
+
+# Length of each reply frame, by its first byte (and the second for 0x0f replies)
+STATE_REPLY = 14
+REPLY_LENGTHS = {0x11: 12, 0x22: 88, 0x21: 4} #clock, timers, timers ack
+
+def replyLength(buf):
+    """ Length of the reply frame starting buf, 0 if buf doesn't start with a known
+        reply (skip a byte and try again) or None if more bytes are needed to tell """
+    if not buf: return None
+    if buf[0] == 0x81: return STATE_REPLY
+    if buf[0] == 0x0f:
+        if len(buf) < 2: return None
+        return REPLY_LENGTHS.get(buf[1], 0)
+    return 0
+
+def validState(frame):
+    """ True if frame is a state reply with a good checksum """
+    return len(frame) >= STATE_REPLY and frame[0] == 0x81 and checksum(frame, STATE_REPLY - 1) == frame[STATE_REPLY - 1]
+
+def decodeTimer(buf, offset=0):
+    """ Returns the 14 fields of the timer struct at offset, see LedTimer for the layout """
+    return TIMER.unpack_from(buf, offset)
+
+def reverseLookup(cls, rename=None):
+    """ Builds a value: name table from the int attributes of cls, so a name lookup is a
+        dict get instead of a scan of cls.__dict__ """
+    table = {}
+    for key, value in cls.__dict__.items():
+        if type(value) is int:
+            table[value] = rename(key) if rename is not None else key
+    return table
@@ -5,47 +5,256 @@
 
 from polyglot.nodeserver_api import NodeServer, SimpleNodeServer, Node
 from polyglot.nodeserver_api import PolyglotConnector
+import os
+import time
+import threading
+from socket import error as socket_error
 
-from polyMagicHome_types import MagicHome
+import flux_led
+from polyMagicHome_types import MagicHome, MagicHomeGroup, group_address
+from polyMagicHome_poll import PollEngine, PollResult
+from polyMagicHome_schedule import PollScheduler
+from polyMagicHome_limit import RateLimiter
+from polyMagicHome_metrics import Metrics
+from polyMagicHome_profile import Profiler
+from polyMagicHome_transition import TransitionEngine
+from polyMagicHome_timers import TimerSync, build_timer
+from polyMagicHome_color import ColorEngine
 
 # Test for PyYaml config file.
 #import yaml
 
 VERSION = "0.0.1"
 
+# Override shortpoll and longpoll timers to 5/30, once per second is unnessesary.
+# Bulbs are queried from the short poll as the PollScheduler finds them due, the replies
+# are read by the BulbReactor, and the long poll only reports on the last 30s.
+SHORT_POLL = 5
+LONG_POLL = 30
+
+# Defaults for settings that can be overridden in the node server config
+DEFAULTS = {'poll_workers': 16,       # threads used to query bulbs in parallel
+            'bulb_timeout': 5.,       # seconds a single bulb has to answer a query
+            'cycle_timeout': 25.,     # seconds a whole long_poll cycle may take
+            'scan_timeout': 3.,       # longest a discovery scan may run
+            'scan_quiet': 1.,         # end the scan early once no new LED has replied for this long
+            'probe_timeout': 1.,      # seconds cached LEDs have to answer the startup probe
+            'scan_networks': [],      # CIDRs or interface names swept host by host, for networks that filter broadcasts
+            'sweep_timeout': 1.,      # seconds each swept host has to answer
+            'sweep_concurrency': 256, # most TCP probes in flight during a sweep
+            'command_window_ms': 50,  # changes arriving within this window are merged into one frame
+            'gamma': 1.,              # brightness curve of DON/BRT/DIM levels, 1 for linear, about 2.2 looks even
+            'fade_fps': 10.,          # frames per second sent during a fade (DON ramp, SET_RGB fade time)
+            'state_ttl': 10.,         # seconds an LED's last known state answers QUERY without asking the LED
+            'poll_min': 5.,           # seconds between queries of an LED that just changed or was commanded
+            'poll_max': 300.,         # longest an LED whose state isn't changing goes unqueried
+            'poll_unreachable': 120., # seconds between queries of an LED that isn't answering
+            'poll_budget': 60,        # most state queries per minute across all LEDs, 0 for no limit
+            'rate_global': 50.,       # most requests per second to all LEDs together, 0 for no limit
+            'rate_bulb': 10.,         # most requests per second to one LED, 0 for no limit
+            'subnet_concurrency': 8,  # most requests in flight per /24 subnet (Wi-Fi AP), 0 for no limit
+            'poll_jitter_ms': 200,    # longest random delay before each background query
+            'groups': {},             # group name: list of member LED MAC addresses
+            'timers': [],             # schedules stored on the LEDs themselves, see build_timer
+            'timer_sync': 0.,         # seconds between checks of the LEDs' timers and clocks, 0 for never
+            'clock_drift': 60.,       # seconds an LED's clock may be off before it is set
+            'metrics_port': 0,        # serve Prometheus metrics on http://127.0.0.1:<port>/metrics, 0 for off
+            'metrics_interval': 300., # seconds between metrics summary log lines, 0 for none
+            'profile_cycle_ms': 0,    # profile poll/long_poll/report_drivers calls slower than this, 0 for off
+            'profile_command_ms': 0,  # profile LED and group commands slower than this, 0 for off
+            'profile_file': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'magichome_profile.log'),
+            'cache_file': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery_cache.json')}
+
 class MagicHomeNodeServer(SimpleNodeServer):
     """ Magic Home Node Server """
     controller = []
     bulbs = []
+    groups = []
+    metrics = None
+    profiler = None
 
     def setup(self):
         self.logger = self.poly.logger
+        if self.get_setting('profile_cycle_ms') > 0 or self.get_setting('profile_command_ms') > 0:
+            self.profiler = Profiler(self.get_setting('profile_file'), logger=self.logger)
+            if self.get_setting('profile_cycle_ms') > 0:
+                self.profiler.instrument(self, ('poll', 'long_poll', 'report_drivers'), self.get_setting('profile_cycle_ms') / 1000.)
+        self.metrics = Metrics(self.logger)
+        self._last_summary = time.time()
+        if self.get_setting('metrics_port'):
+            try:
+                self.metrics.serve(self.get_setting('metrics_port'))
+            except socket_error, ex:
+                self.logger.error('Could not serve metrics on port %i. %s', self.get_setting('metrics_port'), str(ex))
+        self.poller = PollEngine(self.get_setting('poll_workers'), self.get_setting('bulb_timeout'),
+                                 self.get_setting('cycle_timeout'), self.logger)
+        self.limiter = RateLimiter(self.get_setting('rate_global'), self.get_setting('rate_bulb'),
+                                   self.get_setting('subnet_concurrency'), self.get_setting('poll_jitter_ms') / 1000.)
+        self.scheduler = PollScheduler(max(SHORT_POLL, self.get_setting('poll_min')), self.get_setting('poll_max'),
+                                       self.get_setting('poll_unreachable'), self.get_setting('poll_budget'))
+        self.colors = ColorEngine(self.get_setting('gamma'))
+        self.fades = TransitionEngine(self.get_setting('fade_fps'), self.logger)
+        self._window = PollResult(time.time()) #outcome of the queries since the last long poll
+        self._window_lock = threading.Lock()
+        self.timers = TimerSync(self.poller, self.get_setting('clock_drift'), self.logger, self.limiter)
+        self._timer_specs = self.load_timers()
+        self._last_timer_sync = 0.
+        self._timer_synced = set() #LEDs tried since the last full sync
+        self._timer_thread = None #sync running in the background, if any
+        self.reactor = flux_led.BulbReactor(self.get_setting('bulb_timeout'), self.logger).start()
         #self.logger.info('Config File param: %s', self.poly.configfile)
         manifest = self.config.get('manifest', {})
         self.controller = MagicHome(self, 'magichome', 'MagicHome Bridge', True, manifest)
-        self.controller.discover()
+        self.controller.start()
+        addresses = {}
+        for name in sorted(self.get_setting('groups')):
+            address = group_address(name)
+            if address in addresses:
+                self.logger.error('Not adding MagicHome group %s, its address %s is taken by group %s. Rename one of them.', name, address, addresses[address])
+                continue
+            addresses[address] = name
+            members = self.get_setting('groups')[name]
+            self.logger.info('Adding MagicHome group %s (%s) with %i members', name, address, len(members))
+            group = MagicHomeGroup(self, self.controller, address, name, members, manifest)
+            self.profile_commands(group)
+            self.groups.append(group)
         self.update_config()
 
+    def profile_commands(self, node):
+        """ Times node's command handlers if command profiling is on """
+        if self.profiler is not None and self.get_setting('profile_command_ms') > 0:
+            self.profiler.instrument_commands(node, self.get_setting('profile_command_ms') / 1000.)
+
+    def get_setting(self, key):
+        """ Returns a setting from the node server config, falling back to DEFAULTS.
+            A string given for a list setting is split on commas """
+        default = DEFAULTS[key]
+        value = self.config.get(key, default)
+        if isinstance(default, list) and isinstance(value, basestring):
+            value = [v.strip() for v in value.split(',') if v.strip()]
+        try:
+            return type(default)(value)
+        except (TypeError, ValueError):
+            self.logger.error('Invalid value for setting %s: %s, using %s', key, str(self.config.get(key)), str(default))
+            return default
+
     def poll(self):
+        self.controller.add_found()
         if len(self.bulbs) >= 1:
+            due = self.scheduler.due()
+            if due:
+                self.query_bulbs(due)
             for i in self.bulbs:
-                i.update_drivers() #only reports currently tracked values without querying the device
+                i.update_drivers(flush=False) #only reports currently tracked values without querying the device
+            self.flush_drivers()
+
+    def query_bulbs(self, bulbs):
+        """ Sends each bulb a state query through the reactor without waiting for the
+            replies.  As each one is answered, or times out, the bulb's drivers are
+            updated and its next query scheduled by whether its state changed.  Those
+            changes go out with the next poll()'s flush, keeping it one flush per cycle. """
+        for i in bulbs:
+            self.reactor.query(i.device, self.queried(i, str(i.device), time.time()))
+
+    def queried(self, node, before, started):
+        """ Returns the reactor callback for one of query_bulbs' queries """
+        def done(device, ok):
+            elapsed = time.time() - started
+            if not ok:
+                self.logger.error('Connection Error on %s MagicHome refreshState. This happens from time to time, normally safe to ignore.', node.name)
+            node.stale = not ok
+            self.scheduler.polled(node, ok, str(device) != before)
+            with self._window_lock:
+                self._window.duration = max(self._window.duration, elapsed)
+                (self._window.ok if ok else self._window.failed).append(node)
+                if not ok: self._window.stale.append(node)
+            node.update_drivers(flush=False)
+            if elapsed > SHORT_POLL:
+                self.logger.warning('Querying %s took %.1fs, longer than the %is short poll interval', node.name, elapsed, SHORT_POLL)
+        return done
+
+    def refresh(self, node):
+        """ PollEngine task querying one LED, as background traffic that gives way to commands """
+        with self.limiter.background():
+            return node.device.refreshState()
 
     def long_poll(self):
         if len(self.bulbs) >= 1:
-            for i in self.bulbs:
-                i.update_info() #queries the device then reports the updated values
+            with self._window_lock:
+                window, self._window = self._window, PollResult(time.time())
+            self.controller.report_cycle(window, self.scheduler.stats())
+            limits = self.limiter.stats()
+            self.logger.info('Rate limiter: %i requests, %i delayed, %i gave up waiting', limits['granted'], limits['delayed'], limits['throttled'])
+            fades = self.fades.stats()
+            if fades['frames'] or fades['dropped'] or fades['active']:
+                self.logger.info('Fades: %i finished, %i running, %i frames sent, %i dropped', fades['completed'], fades['active'], fades['frames'], fades['dropped'])
+        self.sync_timers()
+        interval = self.get_setting('metrics_interval')
+        if interval and time.time() - self._last_summary >= interval:
+            self._last_summary = time.time()
+            self.logger.info('MagicHome metrics: %s', self.metrics.summary())
+
+    def load_timers(self):
+        """ Returns a list of (LED addresses or None for all LEDs, LedTimer) from the timers
+            setting, leaving out (and logging) the entries that can't be understood """
+        specs = []
+        for spec in self.get_setting('timers'):
+            try:
+                leds = spec.get('leds')
+                specs.append(([str(l).lower() for l in leds] if leds else None, build_timer(spec)))
+            except (AttributeError, ValueError), ex:
+                self.logger.error('Ignoring timer %s. %s', str(spec), str(ex))
+        return specs
+
+    def sync_timers(self, force=False):
+        """ Writes the configured timers to every LED whose table differs and sets the
+            clocks that drifted, once per timer_sync interval (and for LEDs not synced yet).
+            The sync runs on its own thread so it never holds up the polls or commands,
+            returns that thread or None if nothing was due or a sync is still running. """
+        interval = self.get_setting('timer_sync')
+        if not interval or not self.bulbs: return None
+        if self._timer_thread is not None and self._timer_thread.is_alive(): return None
+        if force or time.time() - self._last_timer_sync >= interval:
+            self._last_timer_sync = time.time()
+            self._timer_synced.clear()
+            bulbs = self.bulbs
+        else:
+            bulbs = [i for i in self.bulbs if i not in self._timer_synced]
+            if not bulbs: return None
+        self._timer_synced.update(bulbs)
+        schedules = {}
+        for i in bulbs:
+            timers = [t for leds, t in self._timer_specs if leds is None or i.address in leds]
+            # LEDs without a configured timer keep whatever was set up in the app
+            schedules[i.device] = timers or None
+        self._timer_thread = threading.Thread(target=self._sync_timers, args=(schedules,), name='magichome-timers')
+        self._timer_thread.daemon = True
+        self._timer_thread.start()
+        return self._timer_thread
+
+    def _sync_timers(self, schedules):
+        try:
+            stats = self.timers.sync(schedules)
+        except Exception, ex:
+            self.logger.error('Timer sync failed. %s', str(ex))
+            return
+        self.logger.info('Timer sync: %i LEDs read, %i timer tables written, %i unchanged, %i clocks set, %i failed',
+                         stats['read'], stats['written'], stats['unchanged'], stats['clocks'], stats['failed'])
 
     def report_drivers(self):
         if len(self.bulbs) >= 1:
             for i in self.bulbs:
-                i.report_driver()
+                i.flush_drivers(full=True)
+
+    def flush_drivers(self):
+        """ Sends every change collected during a poll cycle in one pass, returns the
+            number of driver values reported """
+        return sum(i.flush_drivers() for i in self.bulbs)
 
 def main():
     # Setup connection, node server, and nodes
     poly = PolyglotConnector()
-    # Override shortpoll and longpoll timers to 5/30, once per second is unnessesary
-    nserver = MagicHomeNodeServer(poly, 5, 30)
+    nserver = MagicHomeNodeServer(poly, SHORT_POLL, LONG_POLL)
     poly.connect()
     poly.wait_for_config()
     poly.logger.info("MagicHome Node Server Interface version " + VERSION + " created. Initiating setup.")
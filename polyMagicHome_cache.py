@@ -0,0 +1,57 @@
+""" On-disk cache of discovered MagicHome controllers, so known LEDs can be registered
+    at startup without waiting on a broadcast scan. """
+
+import json
+import os
+import threading
+import time
+
+
+class DiscoveryCache(object):
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError:
+            data = {}
+        except ValueError as ex:
+            if self.logger is not None:
+                self.logger.error('Ignoring unreadable discovery cache %s. %s', self.path, str(ex))
+            data = {}
+        with self._lock:
+            self._entries = dict((str(k).lower(), v) for k, v in data.items() if isinstance(v, dict) and 'ipaddr' in v)
+        return True
+
+    def save(self):
+        """ Writes the cache to a temporary file and renames it over the old one, so a
+            crash part way through never leaves a truncated cache behind """
+        with self._lock:
+            data = dict(self._entries)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as ex:
+            if self.logger is not None:
+                self.logger.error('Unable to save discovery cache %s. %s', self.path, str(ex))
+            return False
+        return True
+
+    def update(self, device):
+        """ Records a scan result (dict with ipaddr, id and model) as seen now """
+        with self._lock:
+            self._entries[str(device['id']).lower()] = {'ipaddr': device['ipaddr'], 'id': device['id'],
+                                                        'model': device['model'], 'last_seen': int(time.time())}
+
+    def entries(self):
+        with self._lock:
+            return [dict(v) for v in self._entries.values()]
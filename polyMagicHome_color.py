@@ -0,0 +1,129 @@
+""" Batch color math for the MagicHome Node Server.
+    Brightness scaling, COLORS presets and gamma correction for any number of LEDs in
+    one call.  With NumPy installed a batch is a handful of array operations whatever
+    its size; without it (or for a few LEDs, where building the arrays costs more than
+    it saves) the same math runs per LED in plain Python, with the same results.
+    Brightness levels go through a 256 entry gamma table, so with a gamma above 1 the
+    steps of a dim/brighten look even to the eye.  A gamma of 1 changes nothing. """
+
+from itertools import chain, izip, repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BATCH_MIN = 32 #fewer LEDs than this are done in plain Python
+
+
+def gamma_table(gamma):
+    """ Output level (0-255) for each perceived brightness level (0-255) """
+    return [int(round(255 * (i / 255.) ** gamma)) for i in range(256)]
+
+
+def inverse_table(table):
+    """ Perceived brightness level for each output level of gamma_table() """
+    inverse = []
+    i = 0
+    for level in range(256):
+        while i < 255 and table[i] < level: i += 1
+        inverse.append(i)
+    return inverse
+
+
+class ColorEngine(object):
+    """ colors are lists of [r, g, b], levels a list with one brightness level (0-255) per
+        color or a single level for all of them.  A single color with a list of levels
+        is that color at each level, e.g. one COLORS preset for a whole scene.  Inputs
+        are clamped to 0-255. """
+
+    def __init__(self, gamma=1., use_numpy=True):
+        self.gamma = float(gamma)
+        self.lut = gamma_table(self.gamma)
+        self.inverse = inverse_table(self.lut)
+        self.numpy = numpy if use_numpy else None
+        if self.numpy is not None:
+            self._lut = numpy.array(self.lut, dtype=numpy.float64)
+            self._inverse = numpy.array(self.inverse, dtype=numpy.int64)
+
+    def levels(self, colors):
+        """ Perceived brightness (0-255) of each color, from its brightest channel """
+        if self._batch(len(colors)):
+            return self._inverse[self._colors(colors).max(axis=1).astype(self.numpy.int64)].tolist()
+        inverse = self.inverse
+        return [inverse[_clamp(max(c))] for c in colors]
+
+    def scale(self, colors, levels):
+        """ Each color with its brightest channel at its level, black scales from white """
+        count = _count(colors, levels)
+        if self._batch(count):
+            np = self.numpy
+            rgb = self._colors(colors)
+            peak = rgb.max(axis=1)
+            black = peak == 0
+            if black.any():
+                rgb[black] = 255. #no color to scale, use white
+                peak[black] = 255.
+            out = (rgb / peak[:, None]) * self._levels(levels, count)[:, None]
+            return out.astype(np.int64).tolist()
+        lut = self.lut
+        result = []
+        for (r, g, b), level in _pairs(colors, levels, count):
+            if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+                r, g, b = _clamp(r), _clamp(g), _clamp(b)
+            peak = float(max(r, g, b))
+            if peak == 0: r = g = b = peak = 255.
+            level = lut[_clamp(level)]
+            result.append([int((r / peak) * level), int((g / peak) * level), int((b / peak) * level)])
+        return result
+
+    def dim(self, colors, levels):
+        """ Each color with every channel multiplied by its level / 255, for full-brightness
+            presets """
+        count = _count(colors, levels)
+        if self._batch(count):
+            np = self.numpy
+            out = self._colors(colors) * (self._levels(levels, count) / 255.)[:, None]
+            return out.astype(np.int64).tolist()
+        lut = self.lut
+        result = []
+        for (r, g, b), level in _pairs(colors, levels, count):
+            if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+                r, g, b = _clamp(r), _clamp(g), _clamp(b)
+            pct = lut[_clamp(level)] / 255.
+            result.append([int(r * pct), int(g * pct), int(b * pct)])
+        return result
+
+    def _batch(self, count):
+        return self.numpy is not None and count >= BATCH_MIN
+
+    def _colors(self, colors):
+        """ colors as a (len(colors), 3) float array, clamped """
+        np = self.numpy
+        rgb = np.fromiter(chain.from_iterable(colors), np.float64, len(colors) * 3).reshape(-1, 3)
+        return np.clip(rgb, 0, 255, out=rgb)
+
+    def _levels(self, levels, count):
+        """ Output level of each perceived level, as an array of count floats """
+        np = self.numpy
+        levels = np.asarray(levels, dtype=np.float64)
+        if levels.ndim == 0: levels = np.repeat(levels, count)
+        return self._lut[np.clip(levels, 0, 255).astype(np.int64)]
+
+
+def _count(colors, levels):
+    """ Number of results: one per color, or per level for a single color """
+    if len(colors) == 1 and not isinstance(levels, (int, long, float)):
+        return len(levels)
+    return len(colors)
+
+
+def _pairs(colors, levels, count):
+    """ (color, level) for each result """
+    if isinstance(levels, (int, long, float)): levels = repeat(levels, count)
+    if len(colors) == 1: colors = repeat(colors[0], count)
+    return izip(colors, levels)
+
+
+def _clamp(value):
+    return int(min(255, max(0, value)))
@@ -0,0 +1,153 @@
+""" Per-bulb command handling for the MagicHome Node Server. """
+
+import threading
+import time
+import Queue
+
+
+class CommandQueue(object):
+    """ Runs one bulb's commands one at a time, in the order they arrived, on a dedicated
+        worker thread.  Commands that arrive while the bulb is busy wait their turn instead
+        of being dropped. """
+
+    def __init__(self, name, logger=None):
+        self.name = name
+        self.logger = logger
+        self.processed = 0
+        self.wait_max = 0. #longest wait since the last stats(reset=True)
+        self.wait_total = 0.
+        self._waits = 0
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name='magichome-cmd-%s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        self._queue.put((time.time(), func, args, kwargs))
+
+    def stats(self, reset=True):
+        """ Returns a dict of depth, processed, wait_max and wait_avg (seconds) """
+        waits = self._waits
+        stats = {'depth': self.depth, 'processed': self.processed, 'wait_max': self.wait_max,
+                 'wait_avg': self.wait_total / waits if waits else 0.}
+        if reset:
+            self.wait_max = self.wait_total = 0.
+            self._waits = 0
+        return stats
+
+    def _worker(self):
+        while True:
+            queued, func, args, kwargs = self._queue.get()
+            wait = time.time() - queued
+            self.wait_max = max(self.wait_max, wait)
+            self.wait_total += wait
+            self._waits += 1
+            try:
+                func(*args, **kwargs)
+            except Exception as ex:
+                if self.logger is not None:
+                    self.logger.error('Command failed on %s. %s', self.name, str(ex))
+            self.processed += 1
+
+
+class Coalescer(object):
+    """ Merges the color and power changes requested within a short window into one
+        latest-wins target state and sends only the frames needed to reach it, so a burst
+        of SETR/SETG/SETB or a held BRT/DIM costs one frame instead of dozens. """
+
+    def __init__(self, device, window_ms=50, on_sent=None, logger=None, queue=None):
+        self.device = device
+        self.window = max(0, window_ms) / 1000.
+        self.on_sent = on_sent
+        self.queue = queue #CommandQueue the frames are sent from, sent on the calling/timer thread if None
+        self.logger = logger
+        self.requested = 0 #frames the individual commands would have sent
+        self.sent = 0 #frames actually sent
+        self._color = None
+        self._power = None
+        self._sending = None #color being sent by flush() right now
+        self._timer = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock() #one flush sending at a time, so they land in order
+
+    @property
+    def saved(self):
+        return self.requested - self.sent
+
+    @property
+    def pending(self):
+        """ True while a change is waiting for its window to close or being sent """
+        with self._lock:
+            return self._color is not None or self._power is not None or self._sending is not None
+
+    @property
+    def color(self):
+        """ The color the bulb is heading to, pending changes included """
+        with self._lock:
+            if self._color is not None:
+                return list(self._color)
+            if self._sending is not None:
+                return list(self._sending)
+        return list(self.device.color)
+
+    def set(self, color=None, power=None, frames=1):
+        """ Queues a change.  frames is how many frames the command would have sent on its own """
+        with self._lock:
+            if color is not None: self._color = [int(min(255, max(0, c))) for c in color]
+            if power is not None: self._power = bool(power)
+            self.requested += frames
+            if self.window == 0:
+                send_now = True
+            else:
+                send_now = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._due)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if send_now: self._due()
+
+    def _due(self):
+        if self.queue is not None:
+            self.queue.submit(self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        """ Sends the pending target state, returns False if sending failed.  Waits for a
+            flush already sending on another thread first, so when it returns everything
+            set before the call has gone out. """
+        with self._send_lock:
+            with self._lock:
+                color, power = self._color, self._power
+                self._color = self._power = None
+                self._sending = color
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            # anything set from here on starts a new window and a new flush
+            if color is None and power is None:
+                return True
+            ok = True
+            try:
+                if color is not None:
+                    self.device.setRGB(color[0], color[1], color[2])
+                    self.sent += 1
+                if power is True:
+                    self.device.turnOn()
+                    self.sent += 1
+                elif power is False:
+                    self.device.turnOff()
+                    self.sent += 1
+            except Exception as ex:
+                ok = False
+                if self.logger is not None:
+                    self.logger.error('Error sending color %s / power %s to %s. %s', str(color), str(power), str(self.device.ipaddr), str(ex))
+            with self._lock:
+                self._sending = None
+        if self.on_sent is not None:
+            self.on_sent()
+        return ok
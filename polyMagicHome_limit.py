@@ -0,0 +1,180 @@
+""" Rate limiting for the MagicHome Node Server's controller traffic.
+    Every request to a controller (a frame sent, or a frame and its reply) needs a token
+    from the fleet-wide bucket and from its own controller's bucket, plus one of the
+    in-flight slots of its subnet (one Wi-Fi AP, usually).  Interactive commands go
+    ahead of background polls, which are also spread out by a random delay so a poll
+    cycle doesn't hit every controller at the same instant. """
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import flux_led
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket(object):
+    """ rate tokens per second, holding at most burst """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1., self.rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """ Seconds until a token is available """
+        self.refill(now)
+        return 0. if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+
+    def __init__(self, global_rate=50., bulb_rate=10., subnet_concurrency=8, jitter=0.2, subnet_bits=24):
+        """ Rates are requests per second (0 for no limit), subnet_concurrency is the most
+            requests in flight per subnet of subnet_bits (0 for no limit) and jitter is the
+            longest random delay, in seconds, added to each background request """
+        self.global_bucket = TokenBucket(global_rate) if global_rate > 0 else None
+        self.bulb_rate = float(bulb_rate)
+        self.subnet_concurrency = int(subnet_concurrency)
+        self.jitter = float(jitter)
+        self.mask = (0xFFFFFFFF << (32 - subnet_bits)) & 0xFFFFFFFF
+        self.granted = 0 #requests let through
+        self.delayed = 0 #of those, how many had to wait
+        self.throttled = 0 #requests that gave up waiting
+        self._buckets = {} #ipaddr: TokenBucket
+        self._inflight = {} #subnet: requests in flight
+        self._waiting = [0, 0] #blocked acquire() calls by priority
+        self._local = threading.local()
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def priority(self):
+        """ Priority of the calling thread's requests, INTERACTIVE unless in background() """
+        return getattr(self._local, 'priority', INTERACTIVE)
+
+    @contextmanager
+    def background(self):
+        """ Marks the calling thread's requests as background (poll) traffic """
+        previous = self.priority
+        self._local.priority = BACKGROUND
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    @contextmanager
+    def realtime(self):
+        """ Marks the calling thread's requests as frames that are better dropped than sent
+            late: slot() raises flux_led.Throttled straight away instead of waiting """
+        previous = getattr(self._local, 'realtime', False)
+        self._local.realtime = True
+        try:
+            yield
+        finally:
+            self._local.realtime = previous
+
+    def subnet(self, ipaddr):
+        try:
+            parts = [int(p) for p in ipaddr.split('.')]
+            return ((parts[0] << 24) | (parts[1] << 16) | (parts[2] << 8) | parts[3]) & self.mask
+        except (ValueError, IndexError):
+            return ipaddr
+
+    def try_acquire(self, ipaddr, priority=None):
+        """ Takes a request's tokens and slot if they're free right now, returns True if so.
+            Every successful acquire needs a release(). """
+        if priority is None: priority = self.priority
+        with self._cond:
+            if self._wait_time(ipaddr, priority, time.time()) != 0.:
+                return False
+            self._take(ipaddr)
+            return True
+
+    def acquire(self, ipaddr, priority=None, timeout=None):
+        """ Waits (at most timeout seconds) for a request's tokens and slot, returns False
+            if they didn't come free in time """
+        if priority is None: priority = self.priority
+        if priority == BACKGROUND and self.jitter > 0:
+            time.sleep(random.uniform(0, self.jitter))
+        deadline = None if timeout is None else time.time() + timeout
+        waited = False
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.time()
+                    wait = self._wait_time(ipaddr, priority, now)
+                    if wait == 0.:
+                        self._take(ipaddr)
+                        if waited: self.delayed += 1
+                        return True
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.throttled += 1
+                            return False
+                        wait = min(wait, deadline - now)
+                    waited = True
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+
+    def release(self, ipaddr):
+        with self._cond:
+            subnet = self.subnet(ipaddr)
+            self._inflight[subnet] = max(0, self._inflight.get(subnet, 0) - 1)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, ipaddr, timeout=None):
+        """ Holds a request's tokens and slot for the duration of the with block, raises
+            flux_led.Throttled if they don't come free within timeout seconds (at once
+            within realtime()) """
+        if getattr(self._local, 'realtime', False): timeout = 0
+        if not self.acquire(ipaddr, timeout=timeout):
+            raise flux_led.Throttled('No request slot for {} within {}s'.format(ipaddr, timeout))
+        try:
+            yield
+        finally:
+            self.release(ipaddr)
+
+    def stats(self, reset=True):
+        with self._cond:
+            stats = {'granted': self.granted, 'delayed': self.delayed, 'throttled': self.throttled,
+                     'inflight': sum(self._inflight.values())}
+            if reset:
+                self.granted = self.delayed = self.throttled = 0
+        return stats
+
+    def _wait_time(self, ipaddr, priority, now):
+        """ Seconds until this request could go (a guess when waiting on a slot or on
+            higher priority requests), 0 if it can go now.  Called with the lock held. """
+        if priority == BACKGROUND and self._waiting[INTERACTIVE] > 0:
+            return 0.01
+        wait = 0.
+        if self.subnet_concurrency > 0 and self._inflight.get(self.subnet(ipaddr), 0) >= self.subnet_concurrency:
+            wait = 0.05 #woken by release() before then
+        if self.global_bucket is not None:
+            wait = max(wait, self.global_bucket.wait_time(now))
+        if self.bulb_rate > 0:
+            bucket = self._buckets.get(ipaddr)
+            if bucket is None:
+                bucket = self._buckets[ipaddr] = TokenBucket(self.bulb_rate)
+            wait = max(wait, bucket.wait_time(now))
+        return wait
+
+    def _take(self, ipaddr):
+        if self.global_bucket is not None:
+            self.global_bucket.tokens -= 1
+        if self.bulb_rate > 0:
+            self._buckets[ipaddr].tokens -= 1
+        subnet = self.subnet(ipaddr)
+        self._inflight[subnet] = self._inflight.get(subnet, 0) + 1
+        self.granted += 1
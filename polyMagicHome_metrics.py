@@ -0,0 +1,193 @@
+""" Per-bulb instrumentation for the MagicHome Node Server.
+    Every WifiLedBulb operation (connect, write, read, refresh and each command) is timed
+    into a histogram per bulb, failures are counted by kind and the time of the last
+    success is kept.  Metrics renders it all in the Prometheus text format, serves it over
+    HTTP if asked to and sums it up in one log line. """
+
+import bisect
+import socket
+import threading
+import time
+import BaseHTTPServer
+
+import flux_led
+
+# upper bounds (seconds) of the round trip time histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+# operations on the socket itself, where timeouts and short reads originate
+IO_OPS = ('connect', 'write', 'read')
+
+def error_kind(error):
+    """ Short name for what went wrong, used as the kind label """
+    if error is None: return 'failed'
+    if isinstance(error, (flux_led.ReadTimeout, socket.timeout)): return 'timeout'
+    if isinstance(error, flux_led.ShortRead): return 'short_read'
+    if isinstance(error, flux_led.NotConnected): return 'not_connected'
+    if isinstance(error, socket.error): return 'socket_error'
+    return 'error'
+
+
+class Histogram(object):
+    """ Cumulative-on-render histogram with fixed bucket bounds """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) #the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding quantile q (0-1), None if empty """
+        if self.count == 0: return None
+        rank = q * self.count
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class BulbMetrics(object):
+    """ What one controller has been up to, passed to its WifiLedBulb as bulb.metrics """
+
+    def __init__(self, address, ipaddr):
+        self.address = address
+        self.ipaddr = ipaddr
+        self.histograms = {} #op: Histogram
+        self.errors = {} #(op, kind): count
+        self.timeouts = 0
+        self.short_reads = 0
+        self.reconnects = 0
+        self.last_success = None
+        self._lock = threading.Lock()
+
+    def observe(self, op, seconds, ok, error=None):
+        with self._lock:
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = Histogram()
+            histogram.observe(seconds)
+            if ok:
+                self.last_success = time.time()
+                return
+            kind = error_kind(error)
+            self.errors[(op, kind)] = self.errors.get((op, kind), 0) + 1
+            if op in IO_OPS:
+                if kind == 'timeout': self.timeouts += 1
+                elif kind == 'short_read': self.short_reads += 1
+
+    def reconnected(self):
+        with self._lock:
+            self.reconnects += 1
+
+
+class Metrics(object):
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.bulbs = {} #address: BulbMetrics
+        self.started = time.time()
+        self._server = None
+        self._lock = threading.Lock()
+
+    def bulb(self, address, ipaddr):
+        """ Returns the BulbMetrics for address, created on first use """
+        with self._lock:
+            metrics = self.bulbs.get(address)
+            if metrics is None:
+                metrics = self.bulbs[address] = BulbMetrics(address, ipaddr)
+            metrics.ipaddr = ipaddr
+            return metrics
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        def family(name, kind, help):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+        bulbs = sorted(self.bulbs.values(), key=lambda b: b.address)
+        family('magichome_op_seconds', 'histogram', 'Round trip time of each bulb operation.')
+        for b in bulbs:
+            with b._lock:
+                for op, h in sorted(b.histograms.items()):
+                    labels = 'bulb="{}",ip="{}",op="{}"'.format(b.address, b.ipaddr, op)
+                    total = 0
+                    for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+                        total += n
+                        lines.append('magichome_op_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, total))
+                    lines.append('magichome_op_seconds_sum{{{}}} {:.6f}'.format(labels, h.sum))
+                    lines.append('magichome_op_seconds_count{{{}}} {}'.format(labels, h.count))
+        family('magichome_errors_total', 'counter', 'Failed bulb operations by kind.')
+        for b in bulbs:
+            with b._lock:
+                for (op, kind), n in sorted(b.errors.items()):
+                    lines.append('magichome_errors_total{{bulb="{}",ip="{}",op="{}",kind="{}"}} {}'.format(b.address, b.ipaddr, op, kind, n))
+        for name, attr, help in (('magichome_timeouts_total', 'timeouts', 'Connects, writes and reads that timed out.'),
+                                 ('magichome_short_reads_total', 'short_reads', 'Connections closed part way through a reply.'),
+                                 ('magichome_reconnects_total', 'reconnects', 'Connections re-established after the first.')):
+            family(name, 'counter', help)
+            for b in bulbs:
+                lines.append('{}{{bulb="{}",ip="{}"}} {}'.format(name, b.address, b.ipaddr, getattr(b, attr)))
+        family('magichome_last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful operation.')
+        for b in bulbs:
+            if b.last_success is not None:
+                lines.append('magichome_last_success_timestamp_seconds{{bulb="{}",ip="{}"}} {:.3f}'.format(b.address, b.ipaddr, b.last_success))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, op='refresh', slowest=3, silent=300.):
+        """ One line: op p50/p99 over all bulbs, error totals, the slowest bulbs by p99
+            and the bulbs with no success for silent seconds """
+        total = Histogram()
+        slow = []
+        quiet = []
+        now = time.time()
+        for b in self.bulbs.values():
+            with b._lock:
+                h = b.histograms.get(op)
+                if h is not None:
+                    total.counts = [x + y for x, y in zip(total.counts, h.counts)]
+                    total.count += h.count
+                    slow.append((h.quantile(0.99), b.ipaddr))
+                if now - (b.last_success or self.started) > silent:
+                    quiet.append(b.ipaddr)
+        slow = sorted(slow, reverse=True)[:slowest]
+        def ms(seconds):
+            return '-' if seconds is None else '>10s' if seconds == float('inf') else '%ims' % (seconds * 1000)
+        return '{} bulbs, {} p50 {} p99 {} ({} samples), {} timeouts, {} short reads, {} reconnects, slowest: {}, no success for {:.0f}s: {}'.format(
+            len(self.bulbs), op, ms(total.quantile(0.5)), ms(total.quantile(0.99)), total.count,
+            sum(b.timeouts for b in self.bulbs.values()), sum(b.short_reads for b in self.bulbs.values()),
+            sum(b.reconnects for b in self.bulbs.values()),
+            ', '.join('%s %s' % (ip, ms(p99)) for p99, ip in slow) or 'none', silent, ', '.join(sorted(quiet)) or 'none')
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serves render() at http://host:port/metrics from a background thread """
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass #scrapes would flood the node server log
+
+        self._server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        t = threading.Thread(target=self._server.serve_forever, name='magichome-metrics')
+        t.daemon = True
+        t.start()
+        if self.logger is not None:
+            self.logger.info('Serving MagicHome metrics on http://%s:%i/metrics', host, self._server.server_port)
+        return self._server.server_port
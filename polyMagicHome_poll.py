@@ -0,0 +1,116 @@
+""" Parallel poll engine for the MagicHome Node Server.
+    Runs one task per bulb on a bounded pool of worker threads with a per-bulb and a
+    whole-cycle deadline.  Bulbs that miss the deadline are reported as stale and never
+    hold up the rest of the cycle. """
+
+import threading
+import time
+import Queue
+
+
+class PollResult(object):
+    """ Outcome of one poll cycle """
+    def __init__(self, started):
+        self.started = started
+        self.duration = 0.
+        self.ok = []
+        self.failed = []
+        self.stale = []
+
+    def add(self, other):
+        """ Folds another cycle's outcome into this one, duration is the longest of them """
+        self.duration = max(self.duration, other.duration)
+        self.ok.extend(other.ok)
+        self.failed.extend(other.failed)
+        self.stale.extend(other.stale)
+
+    def __str__(self):
+        return '{:.2f}s, {} ok, {} failed, {} stale'.format(self.duration, len(self.ok), len(self.failed), len(self.stale))
+
+
+class PollEngine(object):
+
+    def __init__(self, workers=16, bulb_timeout=5., cycle_timeout=25., logger=None):
+        self.workers = max(1, int(workers))
+        self.bulb_timeout = float(bulb_timeout)
+        self.cycle_timeout = float(cycle_timeout)
+        self.logger = logger
+        self.last_result = None
+        self._queue = Queue.Queue()
+        self._busy = set() #items whose task from an earlier cycle is still running
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name='magichome-poll-%i' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def busy(self):
+        """ Items whose task is still running, late finishers from earlier cycles included """
+        with self._lock:
+            return set(self._busy)
+
+    def run(self, items, task, timeout=None):
+        """ Calls task(item) for every item in parallel and waits at most timeout
+            (default cycle_timeout) seconds.  task should return True on success.
+            items may be a generator, each item is queued as soon as it is yielded and
+            the deadline runs from the last one.  Returns a PollResult. """
+        if timeout is None: timeout = self.cycle_timeout
+        result = PollResult(time.time())
+        done = threading.Condition(self._lock)
+        cycle = {'remaining': 0, 'finished': {}}
+        queued = []
+        for item in items:
+            queued.append(item)
+            with self._lock:
+                if item in self._busy:
+                    #still stuck in an earlier cycle, don't queue it up again
+                    result.stale.append(item)
+                    continue
+                self._busy.add(item)
+                cycle['remaining'] += 1
+                self._queue.put((item, task, cycle, done))
+        items = queued
+        deadline = time.time() + timeout
+        with self._lock:
+            while cycle['remaining'] > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                done.wait(remaining)
+            finished = dict(cycle['finished'])
+            cycle['finished'] = None #late finishers from here on are ignored
+        for item in items:
+            if item in result.stale: continue
+            if item not in finished:
+                result.stale.append(item)
+                continue
+            ok, elapsed = finished[item]
+            if elapsed > self.bulb_timeout:
+                result.stale.append(item)
+            elif ok:
+                result.ok.append(item)
+            else:
+                result.failed.append(item)
+        result.duration = time.time() - result.started
+        self.last_result = result
+        return result
+
+    def _worker(self):
+        while True:
+            item, task, cycle, done = self._queue.get()
+            start = time.time()
+            try:
+                ok = bool(task(item))
+            except Exception as ex:
+                if self.logger is not None:
+                    self.logger.error('Poll task failed for %s. %s', str(item), str(ex))
+                ok = False
+            elapsed = time.time() - start
+            with self._lock:
+                self._busy.discard(item)
+                if cycle['finished'] is not None:
+                    cycle['finished'][item] = (ok, elapsed)
+                    cycle['remaining'] -= 1
+                    done.notify()
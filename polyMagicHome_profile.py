@@ -0,0 +1,129 @@
+""" Opt-in profiling for the MagicHome Node Server.
+    Wrapped calls (poll cycles, command handlers) are only timed, which costs next to
+    nothing.  A watchdog thread dumps the stack of any call still running past its
+    threshold, and the next call of the same name then runs under cProfile so, if it is
+    slow too, where the time went is written out.  Dumps go to a size-rotated file. """
+
+import cProfile
+import logging
+import logging.handlers
+import pstats
+import StringIO
+import sys
+import threading
+import time
+import traceback
+
+
+class Profiler(object):
+
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3, logger=None):
+        self.logger = logger
+        self.calls = {} #name: [calls, slow calls, longest seconds]
+        self._active = {} #token: [name, thread ident, start, threshold, dumped]
+        self._profile_next = set() #names whose next call runs under cProfile
+        self._local = threading.local()
+        self._token = 0
+        self._lock = threading.Lock()
+        self._interval = 1.
+        # a logger of its own so dumps never end up in the node server log
+        self.out = logging.getLogger('magichome.profile')
+        self.out.propagate = False
+        self.out.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.out.addHandler(handler)
+        t = threading.Thread(target=self._watchdog, name='magichome-profile')
+        t.daemon = True
+        t.start()
+        if self.logger is not None:
+            self.logger.info('Profiling enabled, slow calls are written to %s', path)
+
+    def wrap(self, name, func, threshold):
+        """ Returns func timed under name, threshold is in seconds """
+        self._interval = max(0.05, min(self._interval, threshold / 2.))
+        def profiled(*args, **kwargs):
+            return self._call(name, threshold, func, args, kwargs)
+        profiled.__name__ = getattr(func, '__name__', name)
+        profiled.__doc__ = getattr(func, '__doc__', None)
+        return profiled
+
+    def instrument(self, obj, names, threshold):
+        """ Replaces each named method of obj (on the instance only) with a timed one """
+        for name in names:
+            setattr(obj, name, self.wrap(name, getattr(obj, name), threshold))
+
+    def instrument_commands(self, node, threshold):
+        """ Times each of node's command handlers, and the coalescer flush its command
+            queue runs, if it has one """
+        node._commands = dict((cmd, self.wrap('%s %s' % (node.address, cmd), func, threshold))
+                              for cmd, func in node._commands.items())
+        coalescer = getattr(node, 'coalescer', None)
+        if coalescer is not None:
+            coalescer.flush = self.wrap('%s flush' % node.address, coalescer.flush, threshold)
+
+    def _call(self, name, threshold, func, args, kwargs):
+        profile = None
+        if not getattr(self._local, 'profiling', False) and name in self._profile_next:
+            # cProfile only sees the thread it was enabled on, and can't nest
+            self._profile_next.discard(name)
+            self._local.profiling = True
+            profile = cProfile.Profile()
+        with self._lock:
+            self._token += 1
+            token = self._token
+            self._active[token] = [name, threading.current_thread().ident, time.time(), threshold, False]
+        start = time.time()
+        try:
+            if profile is not None:
+                return profile.runcall(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            if profile is not None:
+                self._local.profiling = False
+            with self._lock:
+                dumped = self._active.pop(token)[4]
+                stats = self.calls.setdefault(name, [0, 0, 0.])
+                stats[0] += 1
+                stats[2] = max(stats[2], elapsed)
+                slow = elapsed > threshold
+                if slow:
+                    stats[1] += 1
+            if slow:
+                self._slow(name, elapsed, threshold, profile, dumped)
+
+    def _slow(self, name, elapsed, threshold, profile, dumped):
+        calls, slow, longest = self.calls[name]
+        lines = ['SLOW %s took %ims (threshold %ims, %i of %i calls slow, longest %ims)' % (
+            name, elapsed * 1000, threshold * 1000, slow, calls, longest * 1000)]
+        if profile is not None:
+            out = StringIO.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(30)
+            lines.append(out.getvalue())
+        else:
+            self._profile_next.add(name)
+            if not dumped:
+                lines.append('  next call of %s will be profiled' % name)
+        self.out.info('\n'.join(lines))
+        if self.logger is not None:
+            self.logger.warning('%s took %ims, details in the profile log', name, elapsed * 1000)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self._interval)
+            now = time.time()
+            late = []
+            with self._lock:
+                for call in self._active.values():
+                    name, ident, start, threshold, dumped = call
+                    if not dumped and now - start > threshold:
+                        call[4] = True
+                        late.append((name, ident, now - start))
+            if not late: continue
+            frames = sys._current_frames()
+            for name, ident, running in late:
+                self._profile_next.add(name)
+                frame = frames.get(ident)
+                stack = ''.join(traceback.format_stack(frame)) if frame is not None else '  (thread finished)\n'
+                self.out.info('RUNNING %s for %ims so far, next call will be profiled, stack:\n%s' % (name, running * 1000, stack))
@@ -0,0 +1,127 @@
+""" Adaptive poll scheduling for the MagicHome Node Server.
+    Each bulb has its own poll interval instead of every bulb being queried every long
+    poll.  A bulb that just changed or was just commanded is polled again soon, one that
+    keeps reporting the same state backs off towards the longest interval and one that
+    doesn't answer is only probed now and then.  A token bucket caps the state queries
+    sent across the whole fleet. """
+
+import heapq
+import random
+import threading
+import time
+
+
+class PollScheduler(object):
+
+    def __init__(self, min_interval=5., max_interval=300., unreachable_interval=120., budget=60):
+        """ Intervals are in seconds, budget is the most state queries per minute for the
+            whole fleet (0 for no limit) """
+        self.min_interval = float(min_interval)
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.unreachable_interval = float(unreachable_interval)
+        self.budget = float(budget)
+        self.queries = 0 #queries handed out since the last stats(reset=True)
+        self.deferred = 0 #times a due bulb had to wait for the budget
+        self._heap = [] #(due, seq, item), entries not matching _entries are stale
+        self._entries = {} #item: (due, seq)
+        self._intervals = {} #item: current interval
+        self._unreachable = set()
+        self._touched = set() #touched while being polled
+        self._seq = 0
+        self._tokens = self.budget
+        self._refilled = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, item, delay=None):
+        """ Starts scheduling item, first poll after delay (default min_interval) seconds """
+        with self._lock:
+            self._intervals[item] = self.min_interval
+            self._schedule(item, self.min_interval if delay is None else delay)
+
+    def remove(self, item):
+        with self._lock:
+            self._entries.pop(item, None)
+            self._intervals.pop(item, None)
+            self._unreachable.discard(item)
+            self._touched.discard(item)
+
+    def touch(self, item):
+        """ item was just commanded or changed, poll it again soon to catch what follows """
+        with self._lock:
+            if item not in self._intervals: return
+            self._intervals[item] = self.min_interval
+            entry = self._entries.get(item)
+            if entry is None:
+                self._touched.add(item) #being polled, polled() reschedules it
+            elif entry[0] > time.time() + self.min_interval:
+                self._schedule(item, self.min_interval)
+
+    def due(self):
+        """ Returns the items due for a poll now, oldest first, as far as the budget allows """
+        now = time.time()
+        items = []
+        with self._lock:
+            self._refill(now)
+            while self._heap and self._heap[0][0] <= now:
+                due, seq, item = self._heap[0]
+                if self._entries.get(item) != (due, seq):
+                    heapq.heappop(self._heap) #rescheduled or removed since
+                    continue
+                if self.budget > 0 and self._tokens < 1:
+                    self.deferred += len([1 for d, s, i in self._heap if d <= now and self._entries.get(i) == (d, s)])
+                    break
+                heapq.heappop(self._heap)
+                del self._entries[item]
+                if self.budget > 0: self._tokens -= 1
+                self.queries += 1
+                items.append(item)
+        return items
+
+    def polled(self, item, ok, changed):
+        """ Schedules item's next poll from the outcome of this one, must be called for
+            every item due() returned """
+        with self._lock:
+            if item not in self._intervals: return
+            if item in self._touched:
+                self._touched.discard(item)
+                changed = True
+            if not ok:
+                interval = self.unreachable_interval
+                self._unreachable.add(item)
+            else:
+                self._unreachable.discard(item)
+                if changed:
+                    interval = self.min_interval
+                else:
+                    interval = min(self.max_interval, self._intervals[item] * 2)
+            self._intervals[item] = interval
+            self._schedule(item, interval, jitter=True)
+
+    def interval(self, item):
+        return self._intervals.get(item)
+
+    def stats(self, reset=True):
+        """ Returns a dict of queries and deferred counts, and how many bulbs are polled
+            at the fastest interval, backing off or unreachable """
+        with self._lock:
+            fast = len([i for i, v in self._intervals.items() if v <= self.min_interval and i not in self._unreachable])
+            stats = {'queries': self.queries, 'deferred': self.deferred, 'fast': fast,
+                     'unreachable': len(self._unreachable),
+                     'backing_off': len(self._intervals) - fast - len(self._unreachable)}
+            if reset:
+                self.queries = self.deferred = 0
+        return stats
+
+    def _schedule(self, item, delay, jitter=False):
+        if jitter:
+            # +/-10% so bulbs added together drift apart instead of polling in lockstep
+            delay *= random.uniform(0.9, 1.1)
+        self._seq += 1
+        entry = (time.time() + delay, self._seq)
+        self._entries[item] = entry
+        heapq.heappush(self._heap, entry + (item,))
+
+    def _refill(self, now):
+        if self.budget <= 0: return
+        self._tokens = min(self.budget, self._tokens + (now - self._refilled) * self.budget / 60.)
+        self._refilled = now
@@ -0,0 +1,147 @@
+""" Timer and clock sync for the MagicHome Node Server.
+    Schedules kept on the controllers themselves keep running while the node server is
+    down.  Every controller's timer table and clock are read in parallel, and only the
+    tables that differ from the configured schedule are written (each write rewrites the
+    controller's flash), and only the clocks that drifted past a threshold are set. """
+
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+
+import flux_led
+
+DAYS = dict((name, getattr(flux_led.LedTimer, name)) for name in
+            ('Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su', 'Everyday', 'Weekdays', 'Weekend'))
+
+
+def timer_key(timers):
+    """ What the controller ends up storing for timers, comparable with ==: the active,
+        unexpired timers (at most 6) sendTimers would write, in any order """
+    active = [t for t in timers if t.isActive() and not t.isExpired()][:6]
+    return sorted(bytes(t.toBytes()) for t in active)
+
+
+def build_timer(spec):
+    """ LedTimer for one entry of the timers setting, e.g.
+        {"time": "23:30", "days": "Everyday", "action": "off"}.  days is a LedTimer day
+        name (Everyday, Weekdays, Weekend, Mo..Su) or a comma separated list of them, or
+        date ("2026-12-24") runs it once.  action is "off", "on" or an [r, g, b] color.
+        Raises ValueError for an entry that can't be understood. """
+    try:
+        hour, minute = [int(x) for x in str(spec['time']).split(':')]
+    except (KeyError, ValueError):
+        raise ValueError('time must be "HH:MM"')
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError('time must be "HH:MM"')
+    timer = flux_led.LedTimer()
+    timer.setTime(hour, minute)
+    if spec.get('date'):
+        try:
+            date = datetime.datetime.strptime(str(spec['date']), '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('date must be "YYYY-MM-DD"')
+        timer.setDate(date.year, date.month, date.day)
+    else:
+        mask = 0
+        for day in str(spec.get('days', 'Everyday')).split(','):
+            if day.strip() not in DAYS:
+                raise ValueError('unknown day %s' % day.strip())
+            mask |= DAYS[day.strip()]
+        timer.setRepeatMask(mask)
+    action = spec.get('action', 'off')
+    if action == 'off':
+        timer.setModeTurnOff()
+    elif action == 'on':
+        timer.setModeDefault()
+    else:
+        try:
+            r, g, b = [min(255, max(0, int(c))) for c in action]
+        except (TypeError, ValueError):
+            raise ValueError('action must be "off", "on" or [r, g, b]')
+        timer.setModeColor(r, g, b)
+    timer.setActive(True)
+    return timer
+
+
+class TimerSync(object):
+
+    def __init__(self, poller, max_drift=60., logger=None, limiter=None):
+        """ poller is the PollEngine the controllers are read and written from, max_drift
+            the seconds a controller's clock may be off before it is set.  With limiter
+            (a RateLimiter) all of it is background traffic that gives way to commands. """
+        self.poller = poller
+        self.max_drift = float(max_drift)
+        self.logger = logger
+        self.limiter = limiter
+        self.tables = {} #device: timer_key() of its table as last read or written
+        self.drift = {} #device: seconds its clock was ahead when last read, None if unreadable
+        self._lock = threading.Lock()
+
+    def read(self, devices):
+        """ Reads every device's timer table and clock in parallel, returns a PollResult """
+        return self.poller.run(list(devices), self._read)
+
+    def sync(self, schedules, refresh=True):
+        """ schedules maps each device to the list of LedTimers it should hold, or None to
+            leave its timers alone and only check its clock.  Tables are read first unless
+            refresh is False and they're cached.  Returns a dict of counts: read, written,
+            unchanged, clocks (set) and failed. """
+        stats = {'read': 0, 'written': 0, 'unchanged': 0, 'clocks': 0, 'failed': 0}
+        def task(device):
+            return self._sync(device, schedules[device], refresh, stats)
+        result = self.poller.run(list(schedules), task)
+        stats['failed'] = len(result.failed) + len(result.stale)
+        return stats
+
+    def _read(self, device):
+        with self._background():
+            timers = device.getTimers()
+            sent = time.time()
+            clock = device.getClock()
+        # the controller read its clock somewhere in the round trip, call it the middle
+        now = datetime.datetime.fromtimestamp((sent + time.time()) / 2.)
+        with self._lock:
+            self.tables[device] = timer_key(timers)
+            self.drift[device] = (clock - now).total_seconds() if clock is not None else None
+        return True
+
+    def _sync(self, device, timers, refresh, stats):
+        with self._background():
+            return self._sync_device(device, timers, refresh, stats)
+
+    def _sync_device(self, device, timers, refresh, stats):
+        if refresh or device not in self.tables:
+            self._read(device)
+            self._count(stats, 'read')
+        if timers is not None:
+            wanted = timer_key(timers)
+            if wanted != self.tables.get(device):
+                device.sendTimers(timers)
+                with self._lock:
+                    self.tables[device] = wanted
+                self._count(stats, 'written')
+            else:
+                self._count(stats, 'unchanged')
+        drift = self.drift.get(device)
+        if drift is None or abs(drift) > self.max_drift:
+            if self.logger is not None:
+                self.logger.info('Setting the clock of %s, it was %s', str(device.ipaddr),
+                                 'unreadable' if drift is None else '%+.0fs off' % drift)
+            device.setClock()
+            with self._lock:
+                self.drift[device] = 0.
+            self._count(stats, 'clocks')
+        return True
+
+    @contextmanager
+    def _background(self):
+        if self.limiter is None:
+            yield
+        else:
+            with self.limiter.background():
+                yield
+
+    def _count(self, stats, key):
+        with self._lock:
+            stats[key] += 1
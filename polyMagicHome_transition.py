@@ -0,0 +1,156 @@
+""" Client-side color transitions (fades, ramps) for the MagicHome Node Server.
+    One thread drives every running transition on a fixed frame clock.  Each frame sends
+    the interpolated color as a non-persistent (0x41) frame, so the controller's flash
+    isn't rewritten 10 times a second, and the target is persisted once at the end.  A
+    frame that can't go out on time, because the LED is busy or its rate limit is used
+    up, is dropped rather than sent late, and counted. """
+
+import threading
+import time
+from contextlib import contextmanager
+
+import flux_led
+
+
+class Transition(object):
+
+    def __init__(self, device, start, target, duration, power_on=False, on_done=None):
+        self.device = device
+        self.start = [int(c) for c in start]
+        self.target = [int(c) for c in target]
+        self.duration = float(duration)
+        self.power_on = power_on #turn the LED on with the first frame
+        self.on_done = on_done #on_done(device, target), on the engine thread
+        self.started = None #time of the first frame
+        self.color = list(self.start) #last color sent
+        self.frames = 0
+        self.dropped = 0
+
+    def at(self, now):
+        """ The color due at time now """
+        if self.started is None or self.duration <= 0: return list(self.target)
+        t = min(1., max(0., (now - self.started) / self.duration))
+        return [int(round(s + (e - s) * t)) for s, e in zip(self.start, self.target)]
+
+
+class TransitionEngine(object):
+
+    def __init__(self, frame_rate=10., logger=None):
+        self.interval = 1. / max(1., float(frame_rate))
+        self.logger = logger
+        self.frames = 0 #frames sent since the last stats(reset=True)
+        self.dropped = 0 #frames not sent: LED busy, rate limited, or the engine ran late
+        self.completed = 0
+        self._active = {} #device: Transition
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._loop, name='magichome-transition')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start(self, device, target, duration, start=None, power_on=False, on_done=None):
+        """ Fades device from start (default its current color) to target over duration
+            seconds, replacing any transition it is already running.  on_done(device,
+            target) is called once the last frame is due and should persist target. """
+        with self._cond:
+            if start is None:
+                running = self._active.get(device)
+                start = running.color if running is not None else device.color
+            self._active[device] = Transition(device, start, target, duration, power_on, on_done)
+            self._cond.notify()
+
+    def cancel(self, device):
+        """ Stops device's transition where it is, returns the color last sent or None
+            if it wasn't running one """
+        with self._cond:
+            transition = self._active.pop(device, None)
+        return transition.color if transition is not None else None
+
+    def running(self, device):
+        with self._cond:
+            return device in self._active
+
+    def stats(self, reset=True):
+        with self._cond:
+            stats = {'active': len(self._active), 'frames': self.frames, 'dropped': self.dropped,
+                     'completed': self.completed}
+            if reset:
+                self.frames = self.dropped = self.completed = 0
+        return stats
+
+    def _loop(self):
+        tick = None
+        while True:
+            with self._cond:
+                while not self._active:
+                    tick = None
+                    self._cond.wait()
+                now = time.time()
+                if tick is None:
+                    tick = now
+                elif now < tick:
+                    self._cond.wait(tick - now)
+                    continue #woken early by start(), or the tick is due
+                transitions = self._active.values()
+            now = time.time()
+            late = int((now - tick) / self.interval)
+            if late > 0:
+                # a whole frame behind: skip the missed frames rather than bunch them up
+                with self._cond:
+                    self.dropped += late * len(transitions)
+                for transition in transitions: transition.dropped += late
+                tick += late * self.interval
+            for transition in transitions:
+                self._frame(transition, now)
+            tick += self.interval
+
+    def _frame(self, transition, now):
+        device = transition.device
+        if transition.started is None:
+            transition.started = now
+        done = now - transition.started >= transition.duration
+        if done:
+            with self._cond:
+                if self._active.get(device) is not transition: return #replaced or cancelled
+                del self._active[device]
+                self.completed += 1
+            if transition.on_done is not None:
+                try:
+                    transition.on_done(device, transition.target)
+                except Exception as ex:
+                    if self.logger is not None:
+                        self.logger.error('Transition of %s failed to finish. %s', str(device.ipaddr), str(ex))
+            return
+        color = transition.at(now)
+        sent = False
+        # never wait on a busy LED, or for one to connect: every other LED's frame would be late too
+        if device.connected and device.lock.acquire(False):
+            try:
+                with self._realtime(device):
+                    device.setRGB(color[0], color[1], color[2], persist=False)
+                    if transition.power_on:
+                        device.turnOn()
+                        transition.power_on = False
+                sent = True
+            except (flux_led.BulbError, IOError):
+                pass
+            finally:
+                device.lock.release()
+        with self._cond:
+            if sent:
+                self.frames += 1
+            else:
+                self.dropped += 1
+        if sent:
+            transition.frames += 1
+            transition.color = color
+        else:
+            transition.dropped += 1
+
+    @contextmanager
+    def _realtime(self, device):
+        limiter = device.limiter
+        if limiter is None:
+            yield
+        else:
+            with limiter.realtime():
+                yield
@@ -2,11 +2,18 @@ from polyglot.nodeserver_api import Node
 import time
 import random
 import errno
+import threading
+import Queue
+import re
+import hashlib
 from socket import error as socket_error
 from copy import deepcopy
+from contextlib import contextmanager
 
 #Import classes from flux_led project:
 import flux_led
+from polyMagicHome_cache import DiscoveryCache
+from polyMagicHome_commands import Coalescer, CommandQueue
 
 # Changing these will not update the ISY names and labels, you will have to edit the profile.
 COLORS = {
@@ -28,34 +35,142 @@ def myfloat(value, prec=1):
     """ round and return float """
     return round(float(value), prec)
 
+# GV5 (mode) values, see MODE in the profile
+MODES = {'color': 0, 'ww': 1, 'preset': 2, 'custom': 3, 'unknown': 4}
+# SET_CUSTOM's transition parameter, see CUSTOM_TRANSITION in the profile
+CUSTOM_TRANSITIONS = ['gradual', 'jump', 'strobe']
+
 class MagicHome(Node):
 
     def __init__(self, *args, **kwargs):
         self.flux_led_connector = flux_led
         self.scanner = self.flux_led_connector.BulbScanner()
+        self._found = Queue.Queue() #LEDs found by the background scan, added from the short poll
+        # held while checking for and creating an LED's node: DISCOVER and the short poll both add LEDs
+        self._add_lock = threading.Lock()
         super(MagicHome, self).__init__(*args, **kwargs)
+        self.cache = DiscoveryCache(self.parent.get_setting('cache_file'), self.logger)
+
+    def start(self):
+        """ Registers the LEDs remembered from earlier runs straight away (after checking
+            each one with a direct probe) and looks for new LEDs in the background """
+        known = self.cache.entries()
+        if known:
+            self.logger.info('Probing %i MagicHome LEDs from the discovery cache', len(known))
+            probed = self.scanner.probeIter([e['ipaddr'] for e in known], timeout=self.parent.get_setting('probe_timeout'))
+            self._add_devices(probed)
+        t = threading.Thread(target=self._background_scan, name='magichome-scan')
+        t.daemon = True
+        t.start()
+        return True
 
     def discover(self, *args, **kwargs):
-        manifest = self.parent.config.get('manifest', {})
-        self.scanner.scan(timeout=3)
-        devices = self.scanner.getBulbInfo()
-        self.logger.info('%i bulbs found. Checking status and adding to ISY', len(devices))
-        for d in devices:
-            led =flux_led.WifiLedBulb(d['ipaddr'],d['id'],d['model'])
-            name = name = 'mh ' + str(led.ipaddr).replace('.',' ')
-            address = str(led.macaddr).lower()
-            lnode = self.parent.get_node(address)
-            if not lnode:
-                self.logger.info('Adding new MagicHome LED: %s(%s)', name, address)
-                self.parent.bulbs.append(MagicHomeLED(self.parent, self.parent.get_node('magichome'), address, name, led, manifest))
-        self.parent.long_poll()
+        self._add_devices(self._scan())
+        return True
+
+    def _scan(self):
+        """ Yields each LED found by the broadcast scan, then each new one found by
+            sweeping the scan_networks setting's networks, if any """
+        seen = set()
+        for d in self.scanner.scanIter(timeout=self.parent.get_setting('scan_timeout'), quiet=self.parent.get_setting('scan_quiet')):
+            seen.add(d['id'])
+            yield d
+        networks = self.parent.get_setting('scan_networks')
+        if not networks: return
+        try:
+            swept = self.scanner.sweepIter(networks, timeout=self.parent.get_setting('sweep_timeout'),
+                                           concurrency=self.parent.get_setting('sweep_concurrency'))
+            for d in swept:
+                if d['id'] is None:
+                    self.logger.warning('%s accepts LED connections but never answered discovery, not added', d['ipaddr'])
+                elif d['id'] not in seen:
+                    seen.add(d['id'])
+                    yield d
+        except ValueError, ex:
+            self.logger.error('Could not sweep scan_networks %s. %s', str(networks), str(ex))
+
+    def add_found(self):
+        """ Adds any LEDs the background scan found, must be called from the main thread """
+        devices = []
+        while True:
+            try:
+                devices.append(self._found.get_nowait())
+            except Queue.Empty:
+                break
+        if devices:
+            self._add_devices(devices)
         return True
 
+    def _background_scan(self):
+        try:
+            for d in self._scan():
+                self._found.put(d)
+        except Exception, ex:
+            self.logger.error('Background discovery scan failed. %s', str(ex))
+
+    def _add_devices(self, devices):
+        """ Adds a node for each new device as soon as devices yields it, fetching the
+            state of every new LED exactly once, in parallel, then reporting them all.
+            Safe to run on several threads at once, each LED gets one node.  Returns the
+            number of nodes added. """
+        manifest = self.parent.config.get('manifest', {})
+        found = []
+        added = []
+        def new_nodes():
+            for d in devices:
+                found.append(d)
+                self.cache.update(d)
+                address = str(d['id']).lower()
+                # only the check and the node's creation are serialized, not the (possibly long) scan feeding devices
+                with self._add_lock:
+                    if self.parent.get_node(address): continue
+                    led = flux_led.WifiLedBulb(d['ipaddr'],d['id'],d['model'],timeout=self.parent.get_setting('bulb_timeout'),autoconnect=False)
+                    led.metrics = self.parent.metrics.bulb(address, led.ipaddr)
+                    led.limiter = self.parent.limiter
+                    name = 'mh ' + str(led.ipaddr).replace('.',' ')
+                    self.logger.info('Adding new MagicHome LED: %s(%s)', name, address)
+                    node = MagicHomeLED(self.parent, self.parent.get_node('magichome'), address, name, led, manifest)
+                    self.parent.profile_commands(node)
+                    self.parent.bulbs.append(node)
+                    self.parent.scheduler.add(node)
+                    self.parent.reactor.add(led, node.state_pushed)
+                added.append(node)
+                yield node
+        result = self.parent.poller.run(new_nodes(), self.parent.refresh)
+        self.cache.save()
+        self.logger.info('%i bulbs found, %i new: %s', len(found), len(added), str(result))
+        for i in added:
+            i.stale = i in result.stale
+            i.update_drivers(flush=False)
+        self.parent.flush_drivers()
+        return len(added)
+
     def query(self, **kwargs):
         self.parent.report_drivers()
         return True
 
-    _drivers = {}
+    def report_cycle(self, result, schedule=None):
+        """ Reports the longest query run and number of stale bulbs since the last long
+            poll, the number of frames command coalescing has saved so far, and the total
+            command queue depth and longest command wait since the last cycle.  schedule
+            is the PollScheduler's stats, logged if given. """
+        saved = sum(i.coalescer.saved for i in self.parent.bulbs)
+        queues = [i.commands.stats() for i in self.parent.bulbs]
+        depth = sum(q['depth'] for q in queues)
+        wait = max([q['wait_max'] for q in queues] or [0.])
+        self.logger.info('Long poll cycle: %s, %i command frames saved by coalescing, %i commands queued, longest wait %.3fs', str(result), saved, depth, wait)
+        if schedule is not None:
+            self.logger.info('Poll schedule: %i queries (%i deferred by the budget), %i bulbs polled fast, %i backing off, %i unreachable',
+                             schedule['queries'], schedule['deferred'], schedule['fast'], schedule['backing_off'], schedule['unreachable'])
+        self.set_driver('GV1', int(result.duration * 1000))
+        self.set_driver('GV2', len(result.stale))
+        self.set_driver('GV3', saved)
+        self.set_driver('GV4', depth)
+        self.set_driver('GV5', int(wait * 1000))
+        return True
+
+    _drivers = {'GV1': [0, 56, int], 'GV2': [0, 56, int], 'GV3': [0, 56, int],
+                'GV4': [0, 56, int], 'GV5': [0, 56, int]}
 
     _commands = {'DISCOVER': discover}
     
@@ -68,96 +183,97 @@ class MagicHomeLED(Node):
         self.name = name
         self.address = address
         self.label = self.device.model
-        self.updating = False
+        self.stale = False
+        self._reported = {} #driver values last sent to Polyglot
+        self._dirty = set() #drivers changed since the last flush
+        # update_drivers runs on the main, reactor, command queue and fade threads
+        self._drivers_lock = threading.RLock()
         super(MagicHomeLED, self).__init__(parent, address, name, primary, manifest)
-        self.query()
+        self.commands = CommandQueue(address, self.logger)
+        self.coalescer = Coalescer(self.device, self.parent.get_setting('command_window_ms'), self.command_sent, self.logger, self.commands)
         
-    def update_info(self):
-        self.updating = True
+    def update_info(self, flush=True, force=False):
+        """ Refreshes the LED's state, unless (and force is False) what's tracked for it is
+            newer than the state_ttl setting, from a poll, a reply or a command sent """
+        if not force and self.device.fresh(self.parent.get_setting('state_ttl')):
+            self.update_drivers(flush)
+            return True
         try:
-            self.device.refreshState()
+            ok = self.device.refreshState()
         except Exception, ex:
             self.logger.error('Connection Error on %s MagicHome refreshState. This happens from time to time, normally safe to ignore. %s', self.name, str(ex))
-            return False
-        else:
-            self.update_drivers()
-            self.updating = False
-            return True
+            ok = False
+        self.stale = not ok
+        self.update_drivers(flush)
+        return ok
 
-    def query(self, **kwargs):
-        self.update_info()
-        self.report_driver()
+    def query(self, force=False, **kwargs):
+        self.update_info(flush=False, force=force)
+        self.flush_drivers(full=True)
         return True
 
     def _st(self, **kwargs):
-        self.update_info()
-        self.report_driver()
+        self.update_info(flush=False)
+        self.flush_drivers(full=True)
         return True
 
-    def _set_brightness(self, value=None, **kwargs):
-        if self.updating == True: return
-        self.updating = True
+    def _refresh(self, **kwargs):
+        """ QUERY that always asks the controller """
+        return self.query(force=True)
+
+    def _set(self, **change):
+        """ Queues a change on the coalescer, stopping any fade the LED is running first """
+        self.parent.fades.cancel(self.device)
+        self.coalescer.set(**change)
+
+    def _fade(self, color, seconds, frames=1):
+        """ Fades to color over seconds (turning the LED on from black if it is off), the
+            final color is persisted through the coalescer like any other change """
+        if seconds <= 0:
+            self._set(color=color, power=True, frames=frames)
+            return
+        power_on = self.device.power == 0
+        start = [0,0,0] if power_on else self.coalescer.color
+        self.parent.fades.start(self.device, color, seconds, start=start, power_on=power_on,
+                                on_done=lambda device, target: self.coalescer.set(color=target, power=True if power_on else None, frames=frames))
+
+    def _set_brightness(self, value=None, ramp=0, **kwargs):
         if value is not None:
             _value = int(value / 100. * 255)
             if _value > 0:
-                current_max = float(max(self.device.color))
-                try:
-                    _red = int((self.device.color[0] / current_max) * _value ) #RED
-                    _green = int((self.device.color[1] / current_max) *_value) #GREEN
-                    _blue = int((self.device.color[2] / current_max) *_value) #BLUE
-                    self.device.setRGB(_red,_green,_blue)
-                    self.device.turnOn()
-                    self.logger.info('Received SetBrightness command from ISY. Changing %s brightness to: %i', self.name, _value)
-                except Exception, ex: 
-                    self.logger.error('Error seting brightness on %s to %i. %s', self.name, _value, str(ex))
+                self._fade(self.parent.colors.scale([self.coalescer.color], _value)[0], ramp, frames=2)
+                self.logger.info('Received SetBrightness command from ISY. Changing %s brightness to: %i', self.name, _value)
             else:
-                try:
-                    self.device.turnOff()
-                    self.power = self.device.power
-                    self.logger.info('Received SetBrightness command from ISY of 0, turning off %s.', self.name)
-                except Exception, ex: 
-                    self.logger.error('Error turning off %s (set brightness to 0). %s', self.name, str(ex))
+                self._set(power=False)
+                self.logger.info('Received SetBrightness command from ISY of 0, turning off %s.', self.name)
         else:
-            try:
-                self.device.turnOn()
-                self.power = self.device.power
-                self.logger.info('Received SetBrightness command from ISY. No value specified, turning on %s.', self.name)
-            except Exception, ex: 
-                self.logger.error('Error turning on %s (set brightness to 100). %s', self.name, str(ex))
-        self.updating = False
-        self.update_drivers()
+            self._set(power=True)
+            self.logger.info('Received SetBrightness command from ISY. No value specified, turning on %s.', self.name)
         return True
 
     def _seton(self, **kwargs):
-        if self.updating == True: return
         _value = kwargs.get('value')
+        _ramp = int(kwargs.get('RR.uom42') or 0) / 1000. #ramp time in ms
         if _value is not None:
-            self._set_brightness(value=_value)
+            self._set_brightness(value=int(_value), ramp=_ramp)
+        elif _ramp > 0:
+            #no level given, ramp up to the LED's last color, or full white if it has none
+            _color = self.coalescer.color
+            if max(_color) == 0: _color = [255,255,255]
+            self._fade(_color, _ramp)
+            self.logger.info('Received command to turn on %s over %.1fs.', self.name, _ramp)
         else:
-            self.updating = True
-            try:
-                self.device.turnOn()
-                self.update_drivers()
-                self.logger.info('Received commandto turn on %s.', self.name)
-            except Exception, ex: 
-                self.logger.error('Error turning on %s. %s', self.name, str(ex))
-        self.updating = False
+            self._set(power=True)
+            self.logger.info('Received commandto turn on %s.', self.name)
         return True
         
     def _setoff(self, **kwargs):
-        if self.updating == True: return
-        self.updating = True
-        try:
-            self.device.turnOff()
-            self.update_drivers()
-            self.logger.info('Received commandto turn off %s.', self.name)
-        except Exception, ex: 
-            self.logger.error('Error turning off %s. %s', self.name, str(ex))
-        self.updating = False
+        self._set(power=False)
+        self.logger.info('Received commandto turn off %s.', self.name)
         return True
 
     def _faston(self, **kwargs):
-        _seton(value=100)
+        self._seton(value=100)
         return True
 
     def _apply(self, **kwargs):
@@ -165,83 +281,308 @@ class MagicHomeLED(Node):
         return True
         
     def _setcolor(self, **kwargs): 
-        if self.updating == True: return True
-        self.updating = True
         _color = int(kwargs.get('value'))
-        try:
-            #Scale the RGB values of the specified color based on the current brightness of the bulb:
-            pct_brightness = max(self.device.color) / 255.
-            _red = int(COLORS[_color][1][0] * pct_brightness) #RED
-            _green = int(COLORS[_color][1][1] * pct_brightness) #GREEN
-            _blue = int(COLORS[_color][1][2] * pct_brightness) #BLUE
-            self.device.setRGB(_red,_green,_blue)
-            self.update_drivers()
-            self.logger.info('Received SetColor command from ISY. Changing %s color to: %s', self.name, COLORS[_color][0])
-        except Exception, ex: 
-            self.logger.error('Error seting color on %s to %s. %s', self.name, str(_color), str(ex))
-        self.updating = False
+        if _color not in COLORS:
+            self.logger.error('Error seting color on %s to %s. Unknown color', self.name, str(_color))
+            return True
+        #Scale the RGB values of the specified color based on the current brightness of the bulb:
+        colors = self.parent.colors
+        self._set(color=colors.dim([COLORS[_color][1]], colors.levels([self.coalescer.color]))[0])
+        self.logger.info('Received SetColor command from ISY. Changing %s color to: %s', self.name, COLORS[_color][0])
         return True
         
     def _setmanual(self, **kwargs): 
-        if self.updating == True: return True
-        self.updating = True
         _cmd = kwargs.get('cmd')
         _val = int(kwargs.get('value'))
-        if _cmd == 'SETR': self.device.color[0] = _val
-        if _cmd == 'SETG': self.device.color[1] = _val
-        if _cmd == 'SETB': self.device.color[2] = _val
-        try:
-            self.device.setRGB(self.color[0],self.color[1],self.color[2])
-            self.update_drivers()
-            self.logger.info('Received manual change, updating %s to: %s', self.name, str(self.device.color))
-        except Exception, ex: 
-            self.logger.error('Error setting manual rgb on %s (cmd=%s, value=%s). %s', self.name, str(_cmd), str(_val), str(ex))
-        self.updating = False
+        _color = self.coalescer.color
+        if _cmd == 'SETR': _color[0] = _val
+        if _cmd == 'SETG': _color[1] = _val
+        if _cmd == 'SETB': _color[2] = _val
+        self._set(color=_color)
+        self.logger.info('Received manual change, updating %s to: %s', self.name, str(_color))
         return True
 
     def _setrgb(self, **kwargs):
-        if self.updating == True: return True
-        self.updating = True
         try:
-            self.device.setRGB(int(kwargs.get('R.uom100')), int(kwargs.get('G.uom100')), int(kwargs.get('B.uom100')))
-            self.update_drivers()
-            self.logger.info('Received manual change, updating the LED to: %s', str(kwargs))
-        except Exception, ex: 
+            _color = [int(kwargs.get('R.uom100')), int(kwargs.get('G.uom100')), int(kwargs.get('B.uom100'))]
+            _fade = int(kwargs.get('D.uom42') or 0) / 1000. #fade time in ms
+        except (TypeError, ValueError), ex:
             self.logger.error('Error setting rgb on %s to %s. %s', self.name, str(kwargs), str(ex))
-        self.updating = False
+            return True
+        if _fade > 0:
+            self._fade(_color, _fade)
+        else:
+            self._set(color=_color)
+        self.logger.info('Received manual change, updating the LED to: %s', str(kwargs))
         return True
 
     def _brt(self, **kwargs):
-        if self.updating == True: return True
-        _brightness = int(max(self.device.color) / 255. * 100.)
+        _brightness = int(self.parent.colors.levels([self.coalescer.color])[0] / 255. * 100.)
         _new_brightness = min(100,max(0,_brightness + 3))
         self._set_brightness(value=_new_brightness)
         self.logger.info('Received brighten command, updating %s to: %i', self.name, _new_brightness)
         return True
 
     def _dim(self, **kwargs):
-        if self.updating == True: return True
-        _brightness = int(max(self.device.color) / 255. * 100.)
+        _brightness = int(self.parent.colors.levels([self.coalescer.color])[0] / 255. * 100.)
         _new_brightness = min(100,max(0,_brightness - 3))
         self._set_brightness(value=_new_brightness)
-        self.logger.info('Received brighten command, updating %s to: %i', self.name, _new_brightness)
+        self.logger.info('Received dim command, updating %s to: %i', self.name, _new_brightness)
+        return True
+
+    def _setpreset(self, **kwargs):
+        try:
+            _pattern = int(kwargs.get('value'))
+            _speed = int(kwargs.get('S.uom51') or 50)
+        except (TypeError, ValueError), ex:
+            self.logger.error('Error setting preset pattern on %s to %s. %s', self.name, str(kwargs), str(ex))
+            return True
+        if not flux_led.PresetPattern.valid(_pattern):
+            self.logger.error('Error setting preset pattern on %s to %s. Unknown pattern', self.name, str(_pattern))
+            return True
+        self.parent.fades.cancel(self.device)
+        self.commands.submit(self._send_pattern, self.device.setPresetPattern, _pattern, _speed)
+        self.logger.info('Received SetPreset command from ISY. Running %s on %s at speed %i', flux_led.PresetPattern.valtostr(_pattern), self.name, _speed)
+        return True
+
+    def _setcustom(self, **kwargs):
+        """ Runs a custom pattern of up to four COLORS choices (C1-C4) on the controller """
+        try:
+            _colors = [COLORS[int(kwargs[p])][1] for p in ('C1.uom25', 'C2.uom25', 'C3.uom25', 'C4.uom25') if kwargs.get(p) not in (None, '')]
+            _speed = int(kwargs.get('S.uom51') or 50)
+            _transition = CUSTOM_TRANSITIONS[int(kwargs.get('T.uom25') or 0)]
+        except (TypeError, ValueError, KeyError, IndexError), ex:
+            self.logger.error('Error setting custom pattern on %s to %s. %s', self.name, str(kwargs), str(ex))
+            return True
+        if not _colors:
+            self.logger.error('Error setting custom pattern on %s. No colors given', self.name)
+            return True
+        self.parent.fades.cancel(self.device)
+        self.commands.submit(self._send_pattern, self.device.setCustomPattern, _colors, _speed, _transition)
+        self.logger.info('Received SetCustom command from ISY. Running %s %s on %s at speed %i', _transition, str(_colors), self.name, _speed)
         return True
 
-    def update_drivers(self):
-        self.set_driver('GV4', self.device.connected)
+    def _send_pattern(self, send, *args):
+        """ CommandQueue task: sends color/power changes still waiting in the coalescer
+            first, so they don't land on top of the pattern, then the pattern itself """
+        self.coalescer.flush()
+        send(*args)
+        self.command_sent()
+
+    def command_sent(self):
+        """ Reports what a command changed and has the LED polled again soon, to catch
+            anything else that happens to it """
+        self.update_drivers()
+        self.parent.scheduler.touch(self)
+
+    def state_pushed(self, device):
+        """ Reactor callback for a state frame the LED sent without being asked, e.g.
+            after its remote or the app changed it """
+        self.stale = False
+        self.update_drivers()
+        self.parent.scheduler.touch(self)
+
+    def update_drivers(self, flush=True):
+        """ Sets the drivers from the device's tracked state.  Only values that changed
+            since they were last reported are marked for reporting, and they're sent now
+            unless flush is False (the poll cycles flush every node at the end) """
+        #0=disconnected, 1=connected, 2=waiting to reconnect, 3=connected but not responding
+        _state = self.device.conn.state
+        if self.stale and self.device.connected: _state = 3
+        values = {'GV4': _state, 'ST': self.device.power, 'GV5': MODES.get(self.device.mode, MODES['unknown']),
+                  'GV6': self.device.pattern if self.device.mode == 'preset' else 0,
+                  'GV7': self.device.speed if self.device.mode in ('preset', 'custom') else 0}
         for ind, driver in enumerate(('GV1', 'GV2', 'GV3')):
-            self.set_driver(driver, self.device.color[ind])
-        self.set_driver('ST', self.device.power)
-        #self.report_driver()
+            values[driver] = self.device.color[ind]
+        with self._drivers_lock:
+            for driver, value in values.items():
+                value = self._drivers[driver][2](value)
+                if self._reported.get(driver) != value:
+                    self.set_driver(driver, value, report=False)
+                    self._dirty.add(driver)
+            if flush: self.flush_drivers()
         return True
 
+    def flush_drivers(self, full=False):
+        """ Reports the drivers that changed since the last flush, or all of them if full.
+            Returns the number of drivers reported """
+        with self._drivers_lock:
+            if full:
+                self.report_driver()
+                drivers = self._drivers.keys()
+            else:
+                drivers = sorted(self._dirty)
+                for driver in drivers:
+                    self.report_driver(driver)
+            for driver in drivers:
+                self._reported[driver] = self._drivers[driver][0]
+            self._dirty.clear()
+        return len(drivers)
+
 
     _drivers = {'ST': [0, 51, int], 'GV1': [0, 100, int], 'GV2': [0, 100, int],
-                'GV3': [0, 100, int], 'GV4': [0, 2, int]}
+                'GV3': [0, 100, int], 'GV4': [0, 25, int], 'GV5': [4, 25, int],
+                'GV6': [0, 25, int], 'GV7': [0, 51, int]}
 
     _commands = {'DON': _seton, 'DFON':_faston, 'DOF': _setoff, 'DFOF': _setoff, 'ST': _st,
-                 'QUERY': query, 'BRT': _brt, 'DIM': _dim, 'APPLY': _apply,
+                 'QUERY': query, 'REFRESH': _refresh, 'BRT': _brt, 'DIM': _dim, 'APPLY': _apply,
                  'SET_COLOR': _setcolor, 'SETR': _setmanual, 'SETG': _setmanual,
-                 'SETB': _setmanual, 'SET_RGB': _setrgb}
+                 'SETB': _setmanual, 'SET_RGB': _setrgb, 'SET_PRESET': _setpreset,
+                 'SET_CUSTOM': _setcustom}
+
+    node_def_id = 'magichomeled'
+
+def group_address(name):
+    """ ISY address of the group called name: mhg and the name's letters and digits, or
+        for a long (or non-ASCII) name the first few of them and a hash of the whole name,
+        so it stays put when other groups are added or removed and fits ISY's 14 characters """
+    if isinstance(name, unicode): name = name.encode('utf-8')
+    slug = re.sub('[^a-z0-9]', '', name.lower())
+    if not slug or len(slug) > 11:
+        slug = slug[:5] + hashlib.sha1(name).hexdigest()[:6]
+    return 'mhg' + slug
+
+class MagicHomeGroup(Node):
+    """ Sends one ISY command to every member LED at the same time, over the members'
+        already open connections, so a whole room changes within one round-trip """
+
+    def __init__(self, parent, primary, address, name, members, manifest=None):
+        self.name = name
+        self.address = address
+        self.members = [str(m).lower() for m in members]
+        self.fleet = flux_led.WifiLedFleet(timeout=parent.get_setting('bulb_timeout'))
+        super(MagicHomeGroup, self).__init__(parent, address, name, primary, manifest)
+
+    def _member_nodes(self):
+        nodes = []
+        for address in self.members:
+            node = self.parent.get_node(address)
+            if node and isinstance(node, MagicHomeLED): nodes.append(node)
+        return nodes
+
+    def _send(self, colors=None, on=None):
+        """ Sends every member its color (dict of node: [r,g,b]) and/or power state at once,
+            in order with the commands on the members' own queues, then reports per-member
+            success and the spread of the members' latencies.  A member whose queue is
+            still busy when the others are ready gets the change through its queue instead. """
+        nodes = self._member_nodes()
+        if not nodes:
+            self.logger.warning('Group %s has no member LEDs to command', self.name)
+            return False
+        for n in nodes:
+            self.parent.fades.cancel(n.device) #the group command wins over a member's fade
+        with self._hold(nodes) as held:
+            held = [n for n in nodes if n in held]
+            for n in held:
+                # send a member's changes still waiting in its coalescer window now, or they'd land after the group's frames
+                n.coalescer.flush()
+            if not held:
+                results = {}
+            elif colors is None:
+                results = self.fleet.turnOn(on, bulbs=[n.device for n in held])
+            else:
+                results = self.fleet.setColors(dict((n.device, colors[n]) for n in held), on)
+        queued = [n for n in nodes if n not in held]
+        for n in queued:
+            n.coalescer.set(color=colors[n] if colors is not None else None, power=on)
+        latencies = [self.fleet.latencies[d] for d in results if results[d]]
+        spread = max(latencies) - min(latencies) if latencies else 0.
+        updated = [n for n in held if results.get(n.device)]
+        failed = [n.name for n in held if not results.get(n.device)]
+        if failed:
+            self.logger.error('Group %s: %i of %i members failed: %s', self.name, len(failed), len(nodes), ', '.join(failed))
+        if queued:
+            self.logger.warning('Group %s: %i members busy, change queued for them: %s', self.name, len(queued), ', '.join(n.name for n in queued))
+        self.logger.info('Group %s: %i members updated, latency spread %.1fms', self.name, len(updated), spread * 1000)
+        for n in updated:
+            n.command_sent()
+        self.set_driver('ST', sum(n.device.power for n in nodes) / len(nodes))
+        self.set_driver('GV1', len(updated))
+        self.set_driver('GV2', len(failed))
+        self.set_driver('GV3', int(spread * 1000))
+        return not failed
+
+    @contextmanager
+    def _hold(self, nodes):
+        """ Puts a marker on each member's CommandQueue and waits (at most bulb_timeout) for
+            the queues to reach it, i.e. finish the commands queued before the group's.
+            The queues that got there wait at the marker until the with block ends, so
+            commands queued after the group's go out after it.  Yields those members. """
+        arrived = Queue.Queue()
+        release = threading.Event()
+        timeout = self.parent.get_setting('bulb_timeout')
+        def marker(node):
+            arrived.put(node)
+            release.wait(timeout * 2) #never hold a member's queue for good
+        for n in nodes:
+            n.commands.submit(marker, n)
+        held = set()
+        deadline = time.time() + timeout
+        try:
+            while len(held) < len(nodes):
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                try:
+                    held.add(arrived.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            yield held
+        finally:
+            release.set()
+
+    def _seton(self, **kwargs):
+        _value = kwargs.get('value')
+        if _value is not None and int(_value) > 0:
+            _level = int(int(_value) / 100. * 255)
+            nodes = self._member_nodes()
+            colors = self.parent.colors.scale([n.coalescer.color for n in nodes], _level)
+            self._send(dict(zip(nodes, colors)), on=True)
+        elif _value is not None:
+            self._send(on=False)
+        else:
+            self._send(on=True)
+        self.logger.info('Received command to turn on group %s.', self.name)
+        return True
+
+    def _setoff(self, **kwargs):
+        self._send(on=False)
+        self.logger.info('Received command to turn off group %s.', self.name)
+        return True
+
+    def _faston(self, **kwargs):
+        self._seton(value=100)
+        return True
+
+    def _setcolor(self, **kwargs):
+        _color = int(kwargs.get('value'))
+        if _color not in COLORS:
+            self.logger.error('Error seting color on group %s to %s. Unknown color', self.name, str(_color))
+            return True
+        #Scale the color to each member's own brightness:
+        nodes = self._member_nodes()
+        engine = self.parent.colors
+        colors = engine.dim([COLORS[_color][1]], engine.levels([n.coalescer.color for n in nodes]))
+        self._send(dict(zip(nodes, colors)))
+        self.logger.info('Received SetColor command from ISY. Changing group %s color to: %s', self.name, COLORS[_color][0])
+        return True
+
+    def _setrgb(self, **kwargs):
+        try:
+            _color = [int(kwargs.get('R.uom100')), int(kwargs.get('G.uom100')), int(kwargs.get('B.uom100'))]
+        except (TypeError, ValueError), ex:
+            self.logger.error('Error setting rgb on group %s to %s. %s', self.name, str(kwargs), str(ex))
+            return True
+        self._send(dict((n, _color) for n in self._member_nodes()))
+        self.logger.info('Received manual change, updating group %s to: %s', self.name, str(kwargs))
+        return True
+
+    def query(self, **kwargs):
+        self.report_driver()
+        return True
+
+    _drivers = {'ST': [0, 51, int], 'GV1': [0, 56, int], 'GV2': [0, 56, int], 'GV3': [0, 56, int]}
+
+    _commands = {'DON': _seton, 'DFON': _faston, 'DOF': _setoff, 'DFOF': _setoff, 'QUERY': query,
+                 'SET_COLOR': _setcolor, 'SET_RGB': _setrgb}
 
-    node_def_id = 'magichomeled'
\ No newline at end of file
+    node_def_id = 'magichomegroup'
\ No newline at end of file